@@ -0,0 +1,435 @@
+# -*- coding: utf8 -*-
+#
+# archivedownload.py: download metrics archives, or parse them while downloading
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Download the compressed metrics archives of CollecTor, or a mirror.
+
+ArchiveDownloader stores them uncompressed, resuming interrupted
+downloads and verifying what it got. ArchiveFeed does the same while
+handing out the members of the archive as they arrive, and
+StreamedTarFile reads an archive without storing it at all.
+"""
+
+from contextlib import closing
+import os
+import os.path
+import Queue
+import subprocess
+import sys
+import tarfile
+from tarfile import TarFile
+import threading
+import time
+import urllib2
+import urlparse
+
+# lzma is only used for streaming mode. Without it, we pipe the
+# archive through an external `xz` instead.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from progress import Progress
+from tarindex import iter_tar_contents
+
+COLLECTOR_URL = 'https://collector.torproject.org/archive/relay-descriptors/'
+
+BUF_SIZE = 2**15
+# Number of archives downloaded at the same time
+DOWNLOAD_CONCURRENCY = 4
+# Number of archive members waiting to be parsed, see ArchiveFeed
+FEED_QUEUE_SIZE = 32
+
+def metrics_archive_url(path, archive_dir, base_url=COLLECTOR_URL):
+    """Return the URL of the compressed archive stored as `path` in
+    `archive_dir`."""
+    # A mirror may be given without its trailing slash
+    if not base_url.endswith('/'):
+        base_url += '/'
+    return urlparse.urljoin(base_url, '%s.xz' % (os.path.relpath(path, archive_dir),))
+
+class XzStream(object):
+    """Read-only file object decompressing xz data from another file
+    object as it is read."""
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._decompressor = lzma.LZMADecompressor()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) - self._pos < size):
+            data = self._fileobj.read(BUF_SIZE)
+            if not data:
+                self._eof = True
+                break
+            try:
+                self._buffer = self._buffer[self._pos:] + self._decompressor.decompress(data)
+            except lzma.LZMAError, e:
+                raise IOError("invalid xz data: %s" % (e,))
+            self._pos = 0
+        if size < 0:
+            size = len(self._buffer) - self._pos
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def check_end(self):
+        """Raise IOError unless the whole xz stream has been read and
+        verified."""
+        if self.read(BUF_SIZE) or not self._decompressor.eof:
+            raise IOError("truncated xz data")
+
+    def close(self):
+        pass
+
+class XzProcessStream(object):
+    """Same as XzStream, but decompressing using an `xz` process fed by
+    a separate thread."""
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._process = subprocess.Popen(['xz', '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def _feed(self):
+        try:
+            buf = None
+            while buf != '':
+                buf = self._fileobj.read(BUF_SIZE)
+                self._process.stdin.write(buf)
+        except IOError:
+            pass # xz has been stopped early
+        finally:
+            self._process.stdin.close()
+
+    def read(self, size=-1):
+        return self._process.stdout.read(size)
+
+    def check_end(self):
+        """Raise IOError unless the whole xz stream has been read and
+        verified."""
+        if self.read(BUF_SIZE) or self._process.wait() != 0:
+            raise IOError("truncated or invalid xz data")
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._feeder.join()
+
+def open_xz_stream(fileobj):
+    if lzma:
+        return XzStream(fileobj)
+    return XzProcessStream(fileobj)
+
+class DownloadError(Exception):
+    pass
+
+def check_tar(path):
+    """Raise DownloadError if the tar file is truncated."""
+    size = os.path.getsize(path)
+    try:
+        with closing(TarFile(path)) as tar:
+            for member in tar:
+                if member.offset_data + member.size > size:
+                    raise DownloadError("%s is truncated" % (os.path.basename(path),))
+    except tarfile.TarError, e:
+        raise DownloadError("%s is not a valid tar file: %s" % (os.path.basename(path), e))
+
+class ArchiveDownloader(object):
+    """Download compressed metrics archives and store them uncompressed.
+
+    Compressed data is first written to `<archive>.xz.part`. An interrupted
+    download is resumed from there using an HTTP Range request. Once
+    complete, the archive is uncompressed to `<archive>.part`, which
+    verifies the xz checksums, checked to be a complete tar file, and
+    only then renamed to its final name.
+
+    Archives are stored in `archive_dir` with the same path as on the
+    mirror at `base_url`."""
+    def __init__(self, archive_dir, base_url=COLLECTOR_URL, concurrency=DOWNLOAD_CONCURRENCY):
+        self.archive_dir = archive_dir
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._bytes_read = 0
+        self._progress = Progress("%0.1f MiB downloaded…")
+
+    def download_all(self, paths):
+        pending = list(paths)
+        errors = []
+        def worker():
+            while True:
+                with self._lock:
+                    if not pending or errors:
+                        return
+                    path = pending.pop(0)
+                try:
+                    self.download(path)
+                except Exception, e:
+                    with self._lock:
+                        errors.append(e)
+        threads = [threading.Thread(target=worker) for _ in xrange(min(self.concurrency, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._progress.done(self._bytes_read / 2.0**20)
+        if errors:
+            raise errors[0]
+
+    def download(self, path):
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass # created by another thread
+        compressed = path + '.xz.part'
+        self.fetch(self.url(path), compressed)
+        self.uncompress(compressed, path)
+        print >>sys.stderr, "%s downloaded." % (os.path.basename(path),)
+
+    def url(self, path):
+        return metrics_archive_url(path, self.archive_dir, self.base_url)
+
+    def fetch(self, url, dest):
+        offset = os.path.getsize(dest) if os.path.exists(dest) else 0
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % (offset,))
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 416: # nothing left to download
+                return
+            raise
+        try:
+            if offset and response.getcode() != 206:
+                offset = 0 # range not supported, start over
+            expected_size = response.info().getheader('Content-Length')
+            if expected_size is not None:
+                expected_size = offset + int(expected_size)
+            with open(dest, 'ab' if offset else 'wb') as f:
+                buf = None
+                while buf != '':
+                    buf = response.read(BUF_SIZE)
+                    f.write(buf)
+                    with self._lock:
+                        self._bytes_read += len(buf)
+                        self._progress.update(self._bytes_read / 2.0**20)
+        finally:
+            response.close()
+        # What has been downloaded is kept, so the next run resumes
+        if expected_size is not None and os.path.getsize(dest) != expected_size:
+            raise DownloadError("%s: got %d bytes, expected %d" % (url, os.path.getsize(dest), expected_size))
+
+    def uncompress(self, compressed, path):
+        uncompressed = path + '.part'
+        try:
+            with open(compressed, 'rb') as src:
+                stream = open_xz_stream(src)
+                try:
+                    with open(uncompressed, 'wb') as dst:
+                        buf = None
+                        while buf != '':
+                            buf = stream.read(BUF_SIZE)
+                            dst.write(buf)
+                    stream.check_end()
+                finally:
+                    stream.close()
+            check_tar(uncompressed)
+        except (IOError, DownloadError), e:
+            # Corrupted: the next run will download it all again
+            for part in [compressed, uncompressed]:
+                if os.path.exists(part):
+                    os.unlink(part)
+            raise DownloadError("%s: %s" % (os.path.basename(compressed), e))
+        os.rename(uncompressed, path)
+        os.unlink(compressed)
+
+class GrowingFile(object):
+    """Read-only file object reading a file while another thread is still
+    appending to it. Reads block until data is available, or `complete`
+    is set."""
+    def __init__(self, path, complete):
+        self._file = open(path, 'rb')
+        self._complete = complete
+
+    def read(self, size=-1):
+        while True:
+            complete = self._complete.is_set()
+            data = self._file.read(size)
+            if data or complete:
+                return data
+            time.sleep(0.05)
+
+    def close(self):
+        self._file.close()
+
+class TeeReader(object):
+    """Read-only file object writing what is read from another one to
+    `out`."""
+    def __init__(self, fileobj, out):
+        self._fileobj = fileobj
+        self._out = out
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._out.write(data)
+        return data
+
+# Put in an ArchiveFeed queue after the last member
+END_OF_ARCHIVE = object()
+
+class ArchiveFeed(object):
+    """Download a metrics archive, decompress it and hand out the content
+    of its members as they arrive, each stage running in its own thread.
+
+    The download goes to `<archive>.xz.part` like with ArchiveDownloader,
+    and the decompressor follows that file as it grows. Members are passed
+    through a bounded queue, so a feed that is not read yet only keeps
+    FEED_QUEUE_SIZE members in memory while its download carries on. The
+    uncompressed archive is written and verified on the way, and renamed
+    into place once complete."""
+    def __init__(self, path, downloader, queue_size=FEED_QUEUE_SIZE):
+        self.path = path
+        self.downloader = downloader
+        self._queue = Queue.Queue(queue_size)
+        self._downloaded = threading.Event()
+        self._download_error = None
+        self._stopped = threading.Event()
+        self._decompressor = None
+
+    def start(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                pass # created by another feed
+        compressed = self.path + '.xz.part'
+        # Must exist before the decompressor starts following it
+        open(compressed, 'ab').close()
+        downloader = threading.Thread(target=self._download, args=(compressed,))
+        self._decompressor = threading.Thread(target=self._decompress, args=(compressed,))
+        for thread in [downloader, self._decompressor]:
+            thread.daemon = True
+            thread.start()
+
+    def _download(self, compressed):
+        try:
+            self.downloader.fetch(self.downloader.url(self.path), compressed)
+        except Exception, e:
+            self._download_error = e
+        finally:
+            self._downloaded.set()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _decompress(self, compressed):
+        uncompressed = self.path + '.part'
+        try:
+            source = GrowingFile(compressed, self._downloaded)
+            stream = open_xz_stream(source)
+            try:
+                with open(uncompressed, 'wb') as out:
+                    tee = TeeReader(stream, out)
+                    for content in iter_tar_contents(tarfile.open(fileobj=tee, mode='r|')):
+                        self._put(content)
+                        if self._stopped.is_set():
+                            return
+                    # Keep the end of the archive too
+                    while tee.read(BUF_SIZE):
+                        pass
+                stream.check_end()
+            finally:
+                stream.close()
+                source.close()
+            check_tar(uncompressed)
+            os.rename(uncompressed, self.path)
+            os.unlink(compressed)
+            print >>sys.stderr, "%s downloaded." % (os.path.basename(self.path),)
+            self._put(END_OF_ARCHIVE)
+        except Exception, e:
+            if os.path.exists(uncompressed):
+                os.unlink(uncompressed)
+            self._downloaded.wait()
+            if self._download_error is not None:
+                # Keep what has been downloaded for the next run
+                e = self._download_error
+            elif isinstance(e, (IOError, tarfile.TarError, DownloadError)):
+                os.unlink(compressed)
+                e = DownloadError("%s: %s" % (os.path.basename(compressed), e))
+            self._put(e)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is END_OF_ARCHIVE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def __enter__(self):
+        return iter(self)
+
+    def __exit__(self, exit_type, value, traceback):
+        # Stop the decompressor if the archive has not been read through.
+        # A download still running is left to finish on its own.
+        self._stopped.set()
+        self._decompressor.join()
+
+class StreamedTarFile(object):
+    """Open a compressed metrics archive as a tar stream while it is
+    downloaded. The uncompressed tarball is never written to disk."""
+    def __init__(self, url):
+        self._url = url
+        self._response = None
+        self._stream = None
+        self._tar = None
+
+    def __enter__(self):
+        print >>sys.stderr, "Streaming %s…" % (self._url,)
+        self._response = urllib2.urlopen(self._url)
+        self._stream = open_xz_stream(self._response)
+        self._tar = tarfile.open(fileobj=self._stream, mode='r|')
+        return self._tar
+
+    def __exit__(self, exit_type, value, traceback):
+        self._tar.close()
+        self._stream.close()
+        self._response.close()
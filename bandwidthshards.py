@@ -0,0 +1,178 @@
+# -*- coding: utf8 -*-
+#
+# bandwidthshards.py: consensus bandwidth aggregated per day
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Aggregate consensus bandwidth per day and per relay country, so that
+an interrupted run can resume, and a period overlapping one already
+parsed can reuse its days.
+"""
+
+import datetime
+import json
+import os
+import os.path
+
+def country_at(countries, when):
+    """Return the country at the time `when` from a list of (valid-from,
+    country) in time order. The first country applies before it is valid."""
+    country = countries[0][1]
+    for valid_from, other in countries:
+        if valid_from > when:
+            break
+        country = other
+    return country
+
+def countries_between(countries, start, end):
+    """Return the part of a list of (valid-from, country) that applies
+    between `start` and `end`, starting with the country at `start`."""
+    result = [[start, country_at(countries, start)]]
+    for valid_from, country in countries:
+        if start < valid_from < end and country != result[-1][1]:
+            result.append([valid_from, country])
+    return result
+
+class BandwidthShards(object):
+    """Consensus bandwidth aggregated per day, stored as one JSON file per
+    day in `directory`.
+
+    A shard records the valid-after time of every consensus it includes
+    and the fingerprints of the relays that were looked for. It can be
+    reused as long as these fingerprints include every relay we are
+    interested in now. Otherwise, the day is parsed again.
+
+    Bandwidth is split by the country each relay was in at the time of
+    each consensus, according to `countries`, a dictionary of fingerprint
+    → list of (valid-from, country). A shard records the countries it was
+    split with, and is parsed again when they have changed since.
+
+    A shard also records the probabilities of exiting from each country
+    in each of its consensuses. When `probabilities` is set, a day where
+    they are missing for some consensuses is parsed again."""
+
+    VERSION = 4
+
+    def __init__(self, directory, countries, probabilities=False):
+        self.directory = directory
+        self.countries = countries
+        self.fingerprints = frozenset(countries)
+        self.probabilities = probabilities
+        # Dictionary of day → shard
+        self._shards = {}
+        self._dirty = set()
+
+    def _path(self, day):
+        return os.path.join(self.directory, '%s.json' % (day,))
+
+    def _day_countries(self, day):
+        next_day = datetime.datetime.strptime(day, '%Y-%m-%d').date() + datetime.timedelta(days=1)
+        return dict((fingerprint, countries_between(countries, day, str(next_day)))
+                    for fingerprint, countries in self.countries.iteritems())
+
+    def _new_shard(self, day):
+        return {'version': BandwidthShards.VERSION,
+                'day': day,
+                'fingerprints': sorted(self.fingerprints),
+                'countries': self._day_countries(day),
+                'consensuses': [],
+                'tallies': {},
+                'exit_probabilities': {}}
+
+    def shard(self, day):
+        if day not in self._shards:
+            shard = None
+            if os.path.exists(self._path(day)):
+                with open(self._path(day)) as f:
+                    shard = json.load(f)
+                if shard.get('version') != BandwidthShards.VERSION or \
+                   not self.fingerprints.issubset(shard['fingerprints']) or \
+                   (self.probabilities and
+                    len(shard['exit_probabilities']) < len(shard['consensuses'])):
+                    shard = None
+                else:
+                    day_countries = self._day_countries(day)
+                    if any(shard['countries'][fingerprint] != day_countries[fingerprint]
+                           for fingerprint in self.fingerprints):
+                        shard = None
+            self._shards[day] = shard or self._new_shard(day)
+        return self._shards[day]
+
+    def aggregated(self, days):
+        """Return the valid-after times of the consensuses already
+        aggregated for the given days."""
+        valid_afters = set()
+        for day in days:
+            valid_afters.update(self.shard(day)['consensuses'])
+        return valid_afters
+
+    def add(self, valid_after, tallies, probabilities=None):
+        shard = self.shard(valid_after[:10])
+        if valid_after in shard['consensuses']:
+            return
+        if len(shard['fingerprints']) > len(self.fingerprints):
+            # The shard was written looking for more relays: from now on,
+            # it only has the bandwidth of ours.
+            shard['fingerprints'] = sorted(self.fingerprints)
+            shard['countries'] = dict((fingerprint, shard['countries'][fingerprint])
+                                      for fingerprint in self.fingerprints)
+        shard['consensuses'].append(valid_after)
+        for fingerprint, (bandwidth, status_entries_seen) in tallies.iteritems():
+            country = country_at(self.countries[fingerprint], valid_after)
+            tally = shard['tallies'].setdefault(fingerprint, {}).setdefault(country, [0, 0])
+            tally[0] += bandwidth
+            tally[1] += status_entries_seen
+        if probabilities is not None:
+            shard['exit_probabilities'][valid_after] = probabilities
+        self._dirty.add(shard['day'])
+
+    def flush(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for day in self._dirty:
+            tmp_path = self._path(day) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._shards[day], f)
+            os.rename(tmp_path, self._path(day))
+        self._dirty.clear()
+
+    def sum(self, days):
+        """Return fingerprint → country → [bandwidth, status entries seen]
+        summed over the given days."""
+        tallies = {}
+        for day in days:
+            for fingerprint, countries in self.shard(day)['tallies'].iteritems():
+                if fingerprint not in self.fingerprints:
+                    continue
+                for country, (bandwidth, status_entries_seen) in countries.iteritems():
+                    tally = tallies.setdefault(fingerprint, {}).setdefault(country, [0, 0])
+                    tally[0] += bandwidth
+                    tally[1] += status_entries_seen
+        return tallies
+
+    def exit_probabilities(self, days):
+        """Return (valid-after, country → exit probability) for each
+        consensus of the given days."""
+        consensuses = []
+        for day in days:
+            consensuses.extend((str(valid_after), probabilities) for valid_after, probabilities
+                               in self.shard(day)['exit_probabilities'].iteritems())
+        return consensuses
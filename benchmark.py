@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# benchmark.py: time exit-funding.py on synthetic archives
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Time the stages of exit-funding.py on archives written by
+synthetic_archives.py, without network access or a running Tor."""
+
+import argparse
+import imp
+import json
+import os
+import os.path
+import random
+import resource
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from tarfile import TarFile
+
+from prettytable import PrettyTable
+
+from relaytable import RelayTable
+import synthetic_archives
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# ExitFundingProcessor is only found in the script
+exit_funding = imp.load_source('exit_funding', os.path.join(BASE_DIR, 'exit-funding.py'))
+
+def peak_rss():
+    """Return the peak resident set size of this process and its children,
+    in KiB (the unit used by Linux)."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+@contextmanager
+def quiet_stderr(quiet):
+    """Send what is written on the standard error to /dev/null."""
+    if not quiet:
+        yield
+        return
+    sys.stderr.flush()
+    saved = os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    try:
+        yield
+    finally:
+        sys.stderr.flush()
+        os.dup2(saved, 2)
+        os.close(saved)
+        os.close(devnull)
+
+class Benchmark(object):
+    def __init__(self, quiet=True):
+        self.quiet = quiet
+        # List of dictionaries, one per timed stage
+        self.results = []
+
+    def run(self, stage, documents, func, *args):
+        with quiet_stderr(self.quiet):
+            cpu_before = sum(os.times()[:4])
+            wall_before = time.time()
+            func(*args)
+            wall = time.time() - wall_before
+            cpu = sum(os.times()[:4]) - cpu_before
+        self.results.append({'stage': stage,
+                             'documents': documents,
+                             'wall_time': wall,
+                             'cpu_time': cpu,
+                             'documents_per_second': documents / wall if wall > 0 else None,
+                             'peak_rss_kib': peak_rss()})
+
+    def print_results(self):
+        t = PrettyTable(['Stage', 'Documents', 'Wall time', 'CPU time', 'Documents/s', 'Peak RSS'])
+        t.align['Stage'] = 'l'
+        for column in ['Documents', 'Wall time', 'CPU time', 'Documents/s', 'Peak RSS']:
+            t.align[column] = 'r'
+        for result in self.results:
+            t.add_row([result['stage'],
+                       result['documents'],
+                       "%0.03f s" % (result['wall_time'],),
+                       "%0.03f s" % (result['cpu_time'],),
+                       "%0.01f" % (result['documents_per_second'] or 0,),
+                       "%0.01f MiB" % (result['peak_rss_kib'] / 1024.0,)])
+        print t
+
+def count_members(path):
+    with TarFile(path) as tar:
+        return len([member for member in tar if member.isfile() and member.size > 0])
+
+def random_addresses(count, seed=0):
+    rnd = random.Random(seed)
+    return [socket.inet_ntoa(struct.pack('!I', rnd.randint(1 << 24, (224 << 24) - 1)))
+            for _ in xrange(count)]
+
+def run_benchmarks(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='exit-funding-benchmark-')
+    try:
+        processor = exit_funding.ExitFundingProcessor(args.month, args.amount, jobs=args.jobs,
+                                                      geoip_dir=os.path.join(work_dir, 'geoip'))
+        exit_funding.ARCHIVE_DIR = work_dir
+        descriptors_path = processor.descriptors_path(args.month)
+        consensuses_path = processor.consensuses_path(args.month)
+        if not (os.path.exists(descriptors_path) and os.path.exists(consensuses_path)):
+            print >>sys.stderr, "Writing synthetic archives in %s…" % (work_dir,)
+            synthetic_archives.generate(work_dir, args.month, relays=args.relays,
+                                        consensuses=args.consensuses,
+                                        partner_share=args.partner_share,
+                                        descriptors_per_relay=args.descriptors_per_relay,
+                                        seed=args.seed)
+        # Start from a clean slate: no aggregated consensuses, no known
+        # relays, no cache
+        if os.path.exists(processor.shards_dir):
+            shutil.rmtree(processor.shards_dir)
+        for path in [processor.registry_path, processor.cache_path]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+        benchmark = Benchmark(quiet=not args.verbose)
+        addresses = random_addresses(args.lookups, args.seed)
+        benchmark.run('GeoIP load', 1, processor.load_geoip)
+        benchmark.run('GeoIP lookup', len(addresses), processor.geoip.get_countries, addresses)
+
+        processor.load_partners()
+        processor.relays = {}
+        benchmark.run('parse_descriptors', count_members(descriptors_path), processor.parse_descriptors)
+        benchmark.run('parse_consensuses', count_members(consensuses_path), processor.parse_consensuses)
+
+        processor.table = RelayTable.from_partners(processor.partners)
+        rows = len(processor.table)
+        benchmark.run('cache save', rows, processor.save_cache)
+        benchmark.run('cache load', rows, processor.load_cache)
+
+        def compute_supports():
+            for _ in xrange(args.repeat):
+                processor.compute_supports()
+        benchmark.run('compute_supports (x%d)' % (args.repeat,), rows * args.repeat, compute_supports)
+        return benchmark
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark exit-funding.py on synthetic archives.')
+    parser.add_argument('--month', metavar='YYYY-MM', default='2014-01',
+            help='month of the synthetic archives (default: %(default)s)')
+    parser.add_argument('--amount', type=int, default=2000,
+            help='monthly amount shared (default: %(default)s)')
+    parser.add_argument('--relays', type=int, default=2000,
+            help='number of relays (default: %(default)s)')
+    parser.add_argument('--consensuses', type=int, default=72,
+            help='number of consensuses (default: %(default)s)')
+    parser.add_argument('--partner-share', type=float, default=0.02,
+            help='share of relays run by partners (default: %(default)s)')
+    parser.add_argument('--descriptors-per-relay', type=int, default=2,
+            help='server descriptors published by each relay (default: %(default)s)')
+    parser.add_argument('--lookups', type=int, default=100000,
+            help='number of GeoIP lookups (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=100,
+            help='how many times support is computed (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of processes used to parse archives (default: %(default)s)')
+    parser.add_argument('--work-dir', metavar='DIR',
+            help='keep the archives in DIR, and reuse them if already there '
+                 '(default: a temporary directory)')
+    parser.add_argument('--json', metavar='FILE',
+            help='also write the results to FILE as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='show what exit-funding.py writes on the standard error')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    benchmark = run_benchmarks(args)
+    benchmark.print_results()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(benchmark.results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# -*- coding: utf8 -*-
+#
+# contactmatcher.py: find which partner runs a relay from its contact
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Match the contact line of relays against the contacts of partners.
+
+A partner contact is either a string, matched exactly or once normalized
+(see normalize_contact()), or a dictionary with a `regex` or `glob` key,
+matched against the whole contact, ignoring case.
+
+Exact and normalized contacts are looked up in dictionaries. Patterns
+are compiled together in a few regular expressions, which renumbers
+their groups: backreferences and named groups are refused. A contact
+matched by patterns of two partners is an error. As relays keep
+the same contact over the month, the answer for each distinct contact
+is remembered, so most lookups are a single dictionary lookup.
+"""
+
+import fnmatch
+import re
+import sre_constants
+import sre_parse
+
+# Python does not support more than 100 groups in a regular expression,
+# counting group 0, the whole match.
+MAX_GROUPS = 100
+
+NON_ALNUM_RE = re.compile(r'[^a-z0-9]+')
+
+def normalize_contact(contact):
+    """Return the contact lowercased, with only letters and digits.
+
+    Spacing and the punctuation used to obfuscate addresses are then
+    irrelevant, e.g. `abuse<__aT>icetor{_DoT===}is` and
+    `abuse|aT>|icetor|<doT |is` are the same."""
+    return NON_ALNUM_RE.sub('', contact.lower())
+
+def has_backreference(item):
+    """Tell if a parsed regular expression refers to one of its groups."""
+    if isinstance(item, sre_parse.SubPattern):
+        return any(op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS)
+                   or has_backreference(av) for op, av in item)
+    if isinstance(item, (list, tuple)):
+        return any(has_backreference(value) for value in item)
+    return False
+
+def check_pattern(pattern):
+    """Raise ValueError if the pattern cannot be combined with others.
+    Return its number of groups, not counting group 0."""
+    parsed = sre_parse.parse(pattern)
+    if parsed.pattern.groupdict:
+        raise ValueError("named groups are not supported: %s" % (pattern,))
+    if has_backreference(parsed):
+        raise ValueError("backreferences are not supported: %s" % (pattern,))
+    # parsed.pattern.groups counts group 0 too
+    if parsed.pattern.groups > MAX_GROUPS:
+        raise ValueError("more than %d groups: %s" % (MAX_GROUPS - 1, pattern))
+    return parsed.pattern.groups - 1
+
+def glob_to_regex(glob):
+    # fnmatch adds flags at the end, which would apply to every pattern
+    # of the combined regular expression.
+    return re.sub(r'\(\?[a-zA-Z]+\)$', '', fnmatch.translate(glob))
+
+class ContactMatcher(object):
+    def __init__(self):
+        # Dictionary of contact → partner id
+        self._exact = {}
+        # Dictionary of normalized contact → partner id
+        self._normalized = {}
+        # List of (regular expression, compiled alone, partner id, number
+        # of groups)
+        self._patterns = []
+        # Compiled regular expressions, each with MAX_GROUPS groups at most
+        self._regexes = None
+        # Dictionary of contact → partner id or None, for contacts seen
+        self._memo = {}
+
+    def add(self, partner_id, contact):
+        """Add a contact string or pattern of the given partner."""
+        if isinstance(contact, dict):
+            if 'regex' in contact:
+                # Matched against the whole contact
+                pattern = '(?:%s)\\Z' % (contact['regex'],)
+            elif 'glob' in contact:
+                pattern = glob_to_regex(contact['glob'])
+            else:
+                raise ValueError("invalid contact for %s: %r" % (partner_id, contact))
+            # Fail early on patterns that would break the combined ones
+            groups = check_pattern(pattern)
+            regex = re.compile(pattern, re.IGNORECASE)
+            self._patterns.append((pattern, regex, partner_id, groups))
+            self._regexes = None
+        else:
+            contact = contact.strip()
+            self._exact[contact] = partner_id
+            normalized = normalize_contact(contact)
+            if normalized:
+                other = self._normalized.setdefault(normalized, partner_id)
+                if other != partner_id:
+                    raise ValueError("contact %r of %s also matches %s" % (contact, partner_id, other))
+        self._memo.clear()
+
+    def _compile(self):
+        """Combine the patterns in as few regular expressions as the
+        limit on groups allows. check_pattern() made sure each pattern
+        fits in one."""
+        self._regexes = []
+        chunk = []
+        # Group 0 of the combined regular expression
+        chunk_groups = 1
+        for pattern, _, _, groups in self._patterns:
+            if chunk and chunk_groups + groups > MAX_GROUPS:
+                self._regexes.append(re.compile('|'.join(chunk), re.IGNORECASE))
+                chunk = []
+                chunk_groups = 1
+            chunk.append('(?:%s)' % (pattern,))
+            chunk_groups += groups
+        if chunk:
+            self._regexes.append(re.compile('|'.join(chunk), re.IGNORECASE))
+
+    def _lookup(self, contact):
+        partner_id = self._exact.get(contact.strip())
+        if partner_id is not None:
+            return partner_id
+        partner_id = self._normalized.get(normalize_contact(contact))
+        if partner_id is not None:
+            return partner_id
+        if self._regexes is None:
+            self._compile()
+        if not any(regex.match(contact) for regex in self._regexes):
+            return None
+        # Few contacts get here: find every partner with a matching pattern
+        partner_ids = sorted(set(partner_id for _, regex, partner_id, _ in self._patterns
+                                 if regex.match(contact)))
+        if len(partner_ids) > 1:
+            raise ValueError("contact %r matches patterns of %s" % (contact, ' and '.join(partner_ids)))
+        return partner_ids[0]
+
+    def match(self, contact):
+        """Return the id of the partner with the given contact, or None."""
+        if contact is None:
+            return None
+        try:
+            return self._memo[contact]
+        except KeyError:
+            partner_id = self._memo[contact] = self._lookup(contact)
+            return partner_id
+
+    def __contains__(self, contact):
+        return self.match(contact) is not None
@@ -23,39 +23,15 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import json
-import math
-import numpy
-import os
-import os.path
-import subprocess
-import sys
+"""Print country factors for a month, k * b^-z where z is the standard score
+of the country exit probability, averaged over the consensuses of the month."""
 
-try:
-    COMPASS_DIR = os.environ['COMPASS_DIR']
-except KeyError:
-    COMPASS_DIR = '../compass'
-COMPASS = os.path.join(COMPASS_DIR, 'compass.py')
-sys.path = [COMPASS_DIR] + sys.path
-import compass
+from countryfactors import helper_main, z_score_factors
 
-results = json.loads(subprocess.check_output([COMPASS, '--json', '--top=-1', '--by-country']))['results']
-p_exits = {}
-for line in results:
-    p_exits[line['cc'].lower()] = line['p_exit'] / 100.0
+def add_arguments(parser):
+    parser.add_argument('-b', type=float, default=1.3, help='base of the power law')
+    parser.add_argument('-k', type=float, default=2, help='factor of an average country')
 
-factors = {}
-
-values = numpy.array(p_exits.values())
-mean = float(numpy.mean(values))
-std_dev = float(numpy.std(values))
-
-b = 1.3
-k = 2
-
-for country, p_exit in p_exits.iteritems():
-    std_score = (p_exit - mean) / std_dev
-    factors[country] = k * math.pow(b, -std_score)
-
-for country, factor in factors.iteritems():
-    print "%s: %f" % (country, factor)
+if __name__ == '__main__':
+    helper_main(__doc__, lambda values, args, p_exits=None: z_score_factors(values, args.b, args.k, p_exits),
+                add_arguments)
@@ -0,0 +1,292 @@
+# -*- coding: utf8 -*-
+#
+# countryfactors.py: exit probabilities and incentive factors by country
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Compute the probability of exiting the Tor network from each country,
+like Compass does with `--by-country`, but directly from consensuses.
+
+A relay is used in the exit position with a weight of its consensus
+bandwidth times `Wee`, or `Wed` if it is also a guard. The probability
+of exiting from a country is the share of these weights for the exits
+located in that country.
+
+Incentive factors are computed for every consensus of a month from a
+country × consensus matrix of these probabilities, then averaged over
+the month. The matrix of a consensus archive is cached next to it,
+e.g. `consensuses-2014-01.tar.probabilities.npz`, along with a digest of
+the archive and GeoIP files it was computed from.
+"""
+
+import argparse
+import hashlib
+import os
+import os.path
+import re
+import sys
+import warnings
+
+import numpy
+import yaml
+
+from geoipdb import UNKNOWN_COUNTRY, GeoIPDatabase, find_geoip_files
+from tarindex import TarIndex, read_members
+
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'archives')
+GEOIP_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'geoip')
+
+# r nickname identity digest date time address ORPort DirPort, then the
+# `s` and `w` lines of the same entry
+STATUS_ENTRY_RE = re.compile(r'^r \S+ \S+ \S+ \S+ \S+ (\S+) \d+ \d+\n'
+                             r'(?:a [^\n]*\n)*'
+                             r's ([^\n]*)\n'
+                             r'(?:v [^\n]*\n)?(?:pr [^\n]*\n)?'
+                             r'w Bandwidth=(\d+)', re.MULTILINE)
+BANDWIDTH_WEIGHTS_RE = re.compile(r'^bandwidth-weights (.*)$', re.MULTILINE)
+# Bandwidth weights are given in parts per WEIGHT_SCALE
+WEIGHT_SCALE = 10000.0
+
+# Exit probabilities, in percent, kept for the trimmed standard deviation,
+# and percentiles at which they are clipped for the winsorized one
+TRIMMED_RANGE = (0.02, 6.50)
+WINSORIZED_PERCENTILES = (10, 95)
+
+def bandwidth_weights(content):
+    """Return the dictionary of bandwidth weights of a consensus, e.g.
+    {'Wee': 10000, …}, or an empty dictionary for older consensuses."""
+    match = BANDWIDTH_WEIGHTS_RE.search(content)
+    if not match:
+        return {}
+    return dict((key, int(value)) for key, value in
+                (item.split('=', 1) for item in match.group(1).split()))
+
+def exit_weights(content):
+    """Return the addresses of the exits of a consensus, and a numpy
+    array of their weight in the exit position."""
+    weights = bandwidth_weights(content)
+    wee = weights.get('Wee', WEIGHT_SCALE) / WEIGHT_SCALE
+    wed = weights.get('Wed', WEIGHT_SCALE) / WEIGHT_SCALE
+    addresses = []
+    bandwidths = []
+    guards = []
+    for address, flags, bandwidth in STATUS_ENTRY_RE.findall(content):
+        flags = flags.split()
+        if 'Exit' in flags and 'BadExit' not in flags:
+            addresses.append(address)
+            bandwidths.append(int(bandwidth))
+            guards.append('Guard' in flags)
+    bandwidths = numpy.array(bandwidths, dtype=float)
+    return addresses, bandwidths * numpy.where(guards, wed, wee)
+
+def country_exit_probabilities(content, geoip):
+    """Return a dictionary of country → probability of exiting from this
+    country for a consensus, using a GeoIPDatabase."""
+    addresses, weights = exit_weights(content)
+    if not addresses or weights.sum() == 0:
+        return {}
+    countries, indexes = numpy.unique(geoip.get_countries(addresses), return_inverse=True)
+    probabilities = numpy.bincount(indexes, weights=weights) / weights.sum()
+    return dict(zip(countries.tolist(), probabilities.tolist()))
+
+class ProbabilityMatrix(object):
+    """Probabilities of exiting from each country, with one row per
+    country and one column per consensus. A country without any exit in
+    a consensus is NaN there."""
+    VERSION = 1
+
+    def __init__(self, countries, valid_afters, values):
+        self.countries = countries
+        self.valid_afters = valid_afters
+        self.values = values
+
+    @classmethod
+    def from_consensuses(cls, consensuses):
+        """Build the matrix from (valid-after, dictionary of country →
+        probability) pairs, skipping consensuses without exits. Countries
+        unknown to GeoIP are left out."""
+        consensuses = sorted((valid_after, probabilities)
+                             for valid_after, probabilities in consensuses if probabilities)
+        seen = set()
+        for _, probabilities in consensuses:
+            seen.update(probabilities)
+        seen.discard(UNKNOWN_COUNTRY)
+        all_countries = sorted(seen)
+        rows = dict((country, row) for row, country in enumerate(all_countries))
+        values = numpy.full((len(all_countries), len(consensuses)), numpy.nan)
+        for column, (_, probabilities) in enumerate(consensuses):
+            for country, probability in probabilities.iteritems():
+                if country in rows:
+                    values[rows[country], column] = probability
+        return cls(all_countries, [valid_after for valid_after, _ in consensuses], values)
+
+    @classmethod
+    def load(cls, path, digest):
+        """Return the matrix saved at `path`, or None if there is none or
+        if it was computed from other inputs than `digest`."""
+        try:
+            saved = numpy.load(path)
+        except (IOError, ValueError):
+            return None
+        with saved:
+            if int(saved['version']) != ProbabilityMatrix.VERSION or str(saved['digest']) != digest:
+                return None
+            return cls(saved['countries'].tolist(), saved['valid_afters'].tolist(),
+                       saved['values'])
+
+    def save(self, path, digest):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            numpy.savez(f, version=ProbabilityMatrix.VERSION, digest=digest,
+                        countries=numpy.array(self.countries, dtype=str),
+                        valid_afters=numpy.array(self.valid_afters, dtype=str),
+                        values=self.values)
+        os.rename(tmp_path, path)
+
+def inputs_digest(archive_path, geoip_paths):
+    """Return a digest of the consensus archive, by size and modification
+    time as it is big, and of the content of the GeoIP files."""
+    digest = hashlib.sha1()
+    stat = os.stat(archive_path)
+    digest.update('%s %d %d\n' % (os.path.basename(archive_path), stat.st_size, int(stat.st_mtime)))
+    for path in geoip_paths:
+        if path:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def archive_probabilities(archive_path, geoip_paths):
+    """Return the ProbabilityMatrix of the consensuses of an archive,
+    computed with the given `geoip` and `geoip6` files, or read from the
+    cache when they have not changed since."""
+    cache_path = archive_path + '.probabilities.npz'
+    digest = inputs_digest(archive_path, geoip_paths)
+    matrix = ProbabilityMatrix.load(cache_path, digest)
+    if matrix is None:
+        geoip = GeoIPDatabase.load(*geoip_paths)
+        members = [member for member in TarIndex.open(archive_path).members if member.valid_after]
+        matrix = ProbabilityMatrix.from_consensuses(
+                (member.valid_after, country_exit_probabilities(content, geoip))
+                for member, content in zip(members, read_members(archive_path, members)))
+        matrix.save(cache_path, digest)
+    return matrix
+
+def z_score_factors(values, b=1.3, k=2, p_exits=None):
+    """Return a matrix of factors such that countries with a lower exit
+    probability get higher factors: k × b^-z where z is the standard
+    score of the country exit probability among those of the same
+    consensus. With `p_exits`, a matrix with the same columns, return the
+    factors of these probabilities instead, still scored against
+    `values`."""
+    if p_exits is None:
+        p_exits = values
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        std = numpy.nanstd(values, axis=0)
+        std[~(std > 0)] = 1.0
+        return k * numpy.power(b, -(p_exits - numpy.nanmean(values, axis=0)) / std)
+
+def inverse_square_factors(values, weight='trimmed', p_exits=None):
+    """Return a matrix of factors 10 / (σ - σw + p)², where p is the exit
+    probability of a country in percent, σ the standard deviation of the
+    probabilities of the same consensus and σw either their trimmed or
+    their winsorized standard deviation, as `exit-probability-factors.py`
+    used to compute. `p_exits` is as for z_score_factors()."""
+    if p_exits is None:
+        p_exits = values
+    percents = values * 100
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if weight == 'trimmed':
+            low, high = TRIMMED_RANGE
+            with numpy.errstate(invalid='ignore'):
+                kept = (percents >= low) & (percents < high)
+            weight_std = numpy.nanstd(numpy.where(kept, percents, numpy.nan), axis=0)
+        elif weight == 'winsorized':
+            low, high = numpy.nanpercentile(percents, WINSORIZED_PERCENTILES, axis=0)
+            weight_std = numpy.nanstd(numpy.clip(percents, low, high), axis=0)
+        else:
+            raise ValueError("Unknown weight %r" % (weight,))
+        return 10.0 / (numpy.nanstd(percents, axis=0) - weight_std + p_exits * 100) ** 2
+
+def time_averaged(countries, factors):
+    """Return country → factor averaged over the consensuses where it is
+    not NaN, i.e. where the country had exits."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        means = numpy.nanmean(factors, axis=1) if factors.size else numpy.array([])
+    return dict((country, mean) for country, mean in zip(countries, means.tolist())
+                if not numpy.isnan(mean))
+
+def average_factors(matrix, compute_factors, countries=()):
+    """Return country → factor for the consensuses of a ProbabilityMatrix,
+    where `compute_factors(values, p_exits=None)` is e.g.
+    z_score_factors(). A country gets its factors averaged over the
+    consensuses where it had exits. The given `countries` that never had
+    any get the factor of a zero probability, averaged over every
+    consensus, without changing the factors of the others."""
+    factors = time_averaged(matrix.countries, compute_factors(matrix.values))
+    missing = sorted(set(countries) - set(factors) - set([UNKNOWN_COUNTRY]))
+    if missing:
+        zeros = numpy.zeros((len(missing), len(matrix.valid_afters)))
+        factors.update(time_averaged(missing, compute_factors(matrix.values, p_exits=zeros)))
+    return factors
+
+def dump_country_factors(f, factors):
+    """Write factors to a file object in the format of
+    `country-factors.yaml`."""
+    for country in sorted(factors):
+        key = country
+        # YAML would read some country codes otherwise, e.g. `no`
+        if yaml.safe_load(country) != country:
+            key = "'%s'" % (country,)
+        f.write("%s: %f\n" % (key, factors[country]))
+
+def write_country_factors(path, factors):
+    """Write factors in the format of `country-factors.yaml`."""
+    with open(path, 'w') as f:
+        dump_country_factors(f, factors)
+
+def helper_main(description, compute_factors, add_arguments=None):
+    """Command line of the helper scripts: print the factors of a month,
+    from the matrix of its consensus archive, as computed by
+    `compute_factors(values, args, p_exits=None)`, see average_factors()."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR,
+                        help='where exit-funding.py stores archives')
+    parser.add_argument('--geoip-dir', default=GEOIP_DIR,
+                        help='where to look for Tor GeoIP files')
+    if add_arguments:
+        add_arguments(parser)
+    parser.add_argument('month', metavar='YYYY-MM')
+    args = parser.parse_args()
+    if not re.match(r'^\d{4}-\d{2}$', args.month):
+        parser.error("Month must be given as YYYY-MM.")
+    archive_path = os.path.join(args.archive_dir, 'consensuses', 'consensuses-%s.tar' % (args.month,))
+    if not os.path.exists(archive_path):
+        parser.error("%s is missing. Run exit-funding.py for %s first." % (archive_path, args.month))
+    geoip_paths = find_geoip_files(args.geoip_dir, args.month)
+    if not geoip_paths:
+        parser.error("No GeoIP database found.")
+    matrix = archive_probabilities(archive_path, geoip_paths)
+    print >>sys.stderr, "Factors averaged over %d consensuses." % (len(matrix.valid_afters),)
+    factors = average_factors(matrix, lambda values, p_exits=None: compute_factors(values, args, p_exits))
+    dump_country_factors(sys.stdout, factors)
@@ -25,15 +25,26 @@
 
 import sys
 
+import argparse
+import base64
+import binascii
+import collections
+from contextlib import closing, contextmanager
+import cProfile
+import datetime
+import hashlib
+import itertools
+import math
+import multiprocessing
+import numpy
 import yaml
-import pickle
 import os.path
-import operator
+import pstats
+import re
 from prettytable import PrettyTable
-import subprocess
 from tarfile import TarFile
 import textwrap
-import urllib2
+import time
 
 try:
     import stem
@@ -42,250 +53,1156 @@ except ImportError:
     import stem
 
 from stem.control import Controller
-from stem.descriptor.reader import DescriptorReader
+
+from archivedownload import COLLECTOR_URL, ArchiveDownloader, ArchiveFeed, StreamedTarFile, \
+                            metrics_archive_url
+from bandwidthshards import BandwidthShards, country_at
+from contactmatcher import ContactMatcher
+from countryfactors import ProbabilityMatrix, average_factors, country_exit_probabilities, \
+                           write_country_factors, z_score_factors
+from geoipdb import GeoIPDatabase, find_geoip_files
+from progress import Progress
+from periods import batch_months, days_between, months_between, parse_period
+from queryserver import PeriodCache, QueryServer, serve
+from relayregistry import DescriptorRecord, RelayRegistry
+from relaytable import RelayTable, StaleCacheError
+from tarindex import TarIndex, archive_signature, consensus_valid_after, iter_tar_contents, read_members
+from stem.exit_policy import MicroExitPolicy
 
 MAX_MONTHLY_FINANCIAL_SUPPORT = 500
+# Sampled estimates: number of bootstrap resamples, and default maximum
+# width in euros of the confidence interval around each support
+BOOTSTRAP_RESAMPLES = 1000
+SAMPLE_TOLERANCE = 10
 TERM_WIDTH = 72
 ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'archives')
 PARTNERS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'partners.yaml')
 COUNTRY_FACTORS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'country-factors.yaml')
+GEOIP_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'geoip')
 
-BUF_SIZE = 2**15
-def download_and_uncompress(url, dest):
-    response = urllib2.urlopen(url)
-    try:
-        with open(dest, 'w') as archive:
-            process = subprocess.Popen(['xz', '-dc'], stdin=subprocess.PIPE, stdout=archive, stderr=sys.stderr)
-            buf = None
-            bytes_read = 0
-            while buf != '':
-                buf = response.read(BUF_SIZE)
-                bytes_read += len(buf)
-                process.stdin.write(buf)
-                print >>sys.stderr, "Download %s: %d bytes read…\r" % (url, bytes_read),
-            process.stdin.close()
-            retcode = process.poll()
-            if retcode:
-                raise ValueError("Invalid content at %s" % (url,))
-    finally:
-        response.close()
-    print >>sys.stderr, ""
+# Number of periods kept in memory by --serve
+SERVED_PERIODS = 4
+
+class Stats(object):
+    """Counters and per-stage timings of a run."""
+    def __init__(self):
+        # Counter of status entries recorded or skipped, see exit_bandwidth()
+        self.counters = collections.Counter()
+        # Dictionary of archive name → documents parsed
+        self.documents = collections.OrderedDict()
+        # Dictionary of stage name → [wall time, CPU time]
+        self.timings = collections.OrderedDict()
 
-def download_metrics_archive(path):
-    if not os.path.exists(os.path.dirname(path)):
-        os.mkdir(os.path.dirname(path))
-    url = 'https://collector.torproject.org/archive/relay-descriptors/%s.xz' % (os.path.relpath(path,ARCHIVE_DIR),)
-    download_and_uncompress(url, path)
+    def add_documents(self, path, documents):
+        name = os.path.basename(path)
+        self.documents[name] = self.documents.get(name, 0) + documents
+
+    def merge(self, other):
+        self.counters.update(other.counters)
+        for name, documents in other.documents.iteritems():
+            self.documents[name] = self.documents.get(name, 0) + documents
+        for name, (wall, cpu) in other.timings.iteritems():
+            timing = self.timings.setdefault(name, [0.0, 0.0])
+            timing[0] += wall
+            timing[1] += cpu
+
+    @contextmanager
+    def stage(self, name):
+        # CPU time includes the one of worker processes, as they have all
+        # been waited for by the end of a stage.
+        wall = time.time()
+        cpu = sum(os.times()[:4])
+        try:
+            yield
+        finally:
+            timing = self.timings.setdefault(name, [0.0, 0.0])
+            timing[0] += time.time() - wall
+            timing[1] += sum(os.times()[:4]) - cpu
+
+    def report(self):
+        for name, documents in self.documents.iteritems():
+            print >>sys.stderr, "%s: %d documents parsed" % (name, documents)
+        if self.counters:
+            print >>sys.stderr, "Status entries: %d recorded, %d skipped as non-exit, %d skipped as unmeasured" % (
+                    self.counters['recorded'], self.counters['not an exit'], self.counters['unmeasured'])
+        for name, (wall, cpu) in self.timings.iteritems():
+            print >>sys.stderr, "%s: %0.02f s (%0.02f s CPU)" % (name, wall, cpu)
 
 class Partner(object):
+    __slots__ = ['name', 'contacts', 'relays']
+
     def __init__(self, partner_info):
         self.name = partner_info['name']
         self.contacts = partner_info['contacts']
         self.relays = []
-        self.total_bandwidth = None
-        self.support = None
-    def patch(self):
-        self.total_bandwidth = None
-        self.support = None
 
 class Relay(object):
-    def __init__(self, processor, relay_desc):
-        self.nickname = relay_desc.nickname
-        self.fingerprint = relay_desc.fingerprint
-        self.country = processor.get_country(relay_desc.address)
-        self.status_entries_seen = 0
-        self.total_reported_bandwidth = 0
-        self.support = None
-
-    def patch(self):
-        self.support = None
-
-    def record_status_entry_bandwidth(self, status_entry):
-        self.status_entries_seen += 1
-        if not status_entry.exit_policy.is_exiting_allowed():
-            print >>sys.stderr, " + skip %s on %s: not an exit" % (status_entry.fingerprint, status_entry.published)
-            return
-        if status_entry.is_unmeasured:
-            print >>sys.stderr, " + skip %s on %s: unmeasured bandwidth" % (status_entry.fingerprint, status_entry.published)
-            return
-        print >>sys.stderr, " + record %s on %s" % (status_entry.fingerprint, status_entry.published)
-        self.total_reported_bandwidth += status_entry.bandwidth
+    # Relays are many: no __dict__, and the strings they share with
+    # other relays are interned.
+    __slots__ = ['nickname', 'fingerprint', 'country', 'countries', 'tallies']
+
+    def __init__(self, fingerprint, nickname, country, countries):
+        self.nickname = intern(nickname)
+        self.fingerprint = fingerprint
+        # Country of the first descriptor with a partner contact
+        self.country = intern(str(country))
+        # List of (valid-from, country) in time order, see country_at()
+        self.countries = [(valid_from, intern(str(country))) for valid_from, country in countries]
+        # Dictionary of country → [bandwidth, status entries seen]
+        self.tallies = {}
+
+    @property
+    def total_reported_bandwidth(self):
+        return sum(bandwidth for bandwidth, _ in self.tallies.itervalues())
+
+    @property
+    def status_entries_seen(self):
+        return sum(status_entries_seen for _, status_entries_seen in self.tallies.itervalues())
+
+    def record_tally(self, tally, country=None):
+        """Record bandwidth and status entries seen while the relay was in
+        `country`, by default its first country."""
+        bandwidth, status_entries_seen = tally
+        total = self.tallies.setdefault(country or self.country, [0, 0])
+        total[0] += bandwidth
+        total[1] += status_entries_seen
+
+    def country_tallies(self):
+        """Return a list of (country, [bandwidth, status entries seen]),
+        with at least one item."""
+        return sorted(self.tallies.iteritems()) or [(self.country, [0, 0])]
+
+# Dictionary of exit policy summary, as found on the `p` line of status
+# entries, → whether it allows exiting. A month of consensuses only has
+# a few hundred different summaries.
+exit_policies = {}
+
+def exiting_allowed(summary):
+    try:
+        return exit_policies[summary]
+    except KeyError:
+        allowed = exit_policies[summary] = MicroExitPolicy(summary).is_exiting_allowed()
+        return allowed
+
+def status_entry_line(raw_entry, keyword):
+    """Return the value of the first line of a raw status entry starting
+    with `keyword`, or None."""
+    start = raw_entry.find('\n%s ' % (keyword,))
+    if start == -1:
+        return None
+    start += len(keyword) + 2
+    end = raw_entry.find('\n', start)
+    return raw_entry[start:] if end == -1 else raw_entry[start:end]
+
+def exit_bandwidth(raw_entry, counters):
+    """Return the bandwidth to record for a raw status entry, or None if
+    it must be skipped. Why is counted in `counters`.
+
+    Only the `p` and `w` lines are looked at, the way stem reads them."""
+    summary = status_entry_line(raw_entry, 'p')
+    if summary is None or not exiting_allowed(summary):
+        counters['not an exit'] += 1
+        return None
+    weights = dict(item.split('=', 1) for item in (status_entry_line(raw_entry, 'w') or '').split()
+                   if '=' in item)
+    if weights.get('Unmeasured') == '1':
+        counters['unmeasured'] += 1
+        return None
+    counters['recorded'] += 1
+    return int(weights.get('Bandwidth', 0))
+
+def split_members(members, chunks):
+    """Split a list of TarMember in at most `chunks` contiguous lists,
+    keeping the archive order."""
+    chunk_size = max(1, int(math.ceil(len(members) / float(chunks))))
+    return [members[i:i + chunk_size] for i in xrange(0, len(members), chunk_size)]
+
+def count_documents(contents, path, stats):
+    """Pass `contents` through, counting them in `stats` and showing
+    progress."""
+    progress = Progress("%%d documents of %s parsed…" % (os.path.basename(path),))
+    documents_seen = 0
+    for content in contents:
+        documents_seen += 1
+        progress.update(documents_seen)
+        yield content
+    progress.done(documents_seen)
+    stats.add_documents(path, documents_seen)
+
+# Same as what stem uses to find these lines
+ROUTER_LINE_RE = re.compile(r'^(?:opt )?router (\S+) (\S+) ', re.MULTILINE)
+PUBLISHED_LINE_RE = re.compile(r'^(?:opt )?published (\S+ \S+)$', re.MULTILINE)
+CONTACT_LINE_RE = re.compile(r'^(?:opt )?contact(?:[ \t]+(.*))?$', re.MULTILINE)
+FINGERPRINT_LINE_RE = re.compile(r'^(?:opt )?fingerprint(?:[ \t]+(.*))?$', re.MULTILINE)
+SIGNING_KEY_RE = re.compile(r'^signing-key\n-----BEGIN RSA PUBLIC KEY-----\n(.*?)\n-----END RSA PUBLIC KEY-----$',
+                            re.MULTILINE | re.DOTALL)
+
+def descriptor_record(descriptor):
+    """Return the DescriptorRecord of a single raw server descriptor, or
+    None if it lacks what the registry needs."""
+    router = ROUTER_LINE_RE.match(descriptor)
+    published = PUBLISHED_LINE_RE.search(descriptor)
+    if not router or not published:
+        return None
+    match = FINGERPRINT_LINE_RE.search(descriptor)
+    if match and match.group(1):
+        fingerprint = match.group(1).replace(' ', '')
+    else:
+        # Like stem: the fingerprint is the digest of the signing key
+        match = SIGNING_KEY_RE.search(descriptor)
+        if not match:
+            return None
+        fingerprint = hashlib.sha1(base64.b64decode(match.group(1))).hexdigest().upper()
+    contact = CONTACT_LINE_RE.search(descriptor)
+    return DescriptorRecord(fingerprint, published.group(1), router.group(1), router.group(2),
+                            contact and contact.group(1))
+
+def descriptor_records(contents):
+    """Return the DescriptorRecord of every server descriptor in the raw
+    contents.
+
+    Only the few lines the registry needs are looked up, with regular
+    expressions: parsing every descriptor with stem would be far slower."""
+    for content in contents:
+        starts = [match.start() for match in ROUTER_LINE_RE.finditer(content)]
+        for start, end in zip(starts, starts[1:] + [len(content)]):
+            record = descriptor_record(content[start:end])
+            if record:
+                yield record
 
-class VerboseDescriptorReader(object):
-    def __init__(self, targets, *args, **kwargs):
-        self._targets = targets
-        self._entries_seen = 0
-        self._reader = DescriptorReader(targets, *args, **kwargs)
+# What every worker of map_tar_chunks() needs besides its chunk, handed
+# once to each process rather than with every chunk: it can include a
+# whole GeoIPDatabase.
+chunk_extra = None
 
-    def __iter__(self):
-        for d in self._reader:
-            self._entries_seen += 1
-            if self._entries_seen % 25 == 0:
-                print >>sys.stderr, "%d documents parsed…\r" % (self._entries_seen,),
-            yield d
+def init_chunk_worker(extra):
+    global chunk_extra
+    chunk_extra = extra
 
-    def __enter__(self):
-        self._reader.start()
-        return self
+def scan_descriptors(args):
+    """Worker: return the list of DescriptorRecord of the server descriptors,
+    and an empty Counter."""
+    path, members = args
+    return list(descriptor_records(read_members(path, members))), collections.Counter()
 
-    def __exit__(self, exit_type, value, traceback):
-        self._reader.stop()
+def fingerprint_identities(fingerprints):
+    """Return a dictionary of identity → fingerprint, where identity is the
+    base64 form used in the `r` lines of consensuses."""
+    return dict((base64.b64encode(binascii.a2b_hex(fingerprint)).rstrip('='), fingerprint)
+                for fingerprint in fingerprints)
+
+def find_status_entries(content, identities):
+    """Return a list of (fingerprint, raw router status entry) of a
+    consensus for the given identities, see fingerprint_identities().
+
+    Only the start of each `r` line is looked at, so entries of relays we
+    are not interested in are skipped without being parsed."""
+    end = content.find('\ndirectory-footer')
+    if end == -1:
+        end = content.find('\ndirectory-signature')
+    if end == -1:
+        end = len(content)
+    entries = []
+    pos = content.find('\nr ', 0, end)
+    while pos != -1:
+        next_pos = content.find('\nr ', pos + 1, end)
+        # r nickname identity digest publication IP ORPort DirPort
+        # Nicknames are at most 19 characters long and identities 27.
+        identity = content[pos + 3:pos + 64].split(' ', 2)[1]
+        if identity in identities:
+            entries.append((identities[identity], content[pos + 1:(end if next_pos == -1 else next_pos) + 1]))
+        pos = next_pos
+    return entries
+
+def tally_consensus(content, fingerprints, counters):
+    """Return a dictionary of fingerprint → [bandwidth, status entries
+    seen] for the given relays in a single consensus."""
+    tallies = {}
+    for fingerprint, raw_entry in find_status_entries(content, fingerprint_identities(fingerprints)):
+        tally = tallies.setdefault(fingerprint, [0, 0])
+        tally[1] += 1
+        bandwidth = exit_bandwidth(raw_entry, counters)
+        if bandwidth is not None:
+            tally[0] += bandwidth
+    return tallies
+
+class ConsensusSelector(object):
+    """Tell which consensuses must be tallied: those valid after a time
+    in [start, end) that have not been aggregated already. With
+    `every` > 1, only one consensus every `every` hours is wanted."""
+    def __init__(self, start, end, aggregated, every=1):
+        self.start = str(start)
+        self.end = str(end)
+        self.aggregated = aggregated
+        self.every = every
+
+    def in_period(self, valid_after):
+        return valid_after is not None and self.start <= valid_after[:10] < self.end
+
+    def sampled(self, valid_after):
+        if self.every == 1:
+            return True
+        hours = (datetime.datetime.strptime(valid_after[:13], '%Y-%m-%d %H') -
+                 datetime.datetime.strptime(self.start, '%Y-%m-%d'))
+        return (hours.days * 24 + hours.seconds / 3600) % self.every == 0
+
+    def wanted(self, valid_after):
+        return (self.in_period(valid_after)
+                and valid_after not in self.aggregated
+                and self.sampled(valid_after))
+
+def tally_consensuses(args):
+    """Worker: return a list of (valid-after, tallies, exit probabilities)
+    for each wanted consensus, see tally_consensus(), and the Counter of
+    status entries. Exit probabilities are None without a GeoIP database."""
+    path, members = args
+    fingerprints, selector, geoip = chunk_extra
+    results = []
+    counters = collections.Counter()
+    for content in read_members(path, members):
+        valid_after = consensus_valid_after(content)
+        if selector.wanted(valid_after):
+            probabilities = country_exit_probabilities(content, geoip) if geoip else None
+            results.append((valid_after, tally_consensus(content, fingerprints, counters), probabilities))
+    return results, counters
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def relay_country_factors(table, country_factors):
+    """Return the country factor of each relay of the table."""
+    factors = numpy.array([country_factors[country] for country in table.countries], dtype=float)
+    return factors[table.country]
+
+# One way of sharing the money: the amount shared, the maximum support
+# for a single partner, and a dictionary of country → factor.
+Scenario = collections.namedtuple('Scenario', ['amount', 'cap', 'country_factors'])
+
+def sweep_supports(table, scenarios):
+    """Return a scenarios × partners matrix of the financial support each
+    partner would get under each Scenario."""
+    # Scenarios usually share a few factor tables: compute the factors of
+    # every relay once per table.
+    factor_tables = []
+    table_indexes = []
+    for scenario in scenarios:
+        for index, country_factors in enumerate(factor_tables):
+            if country_factors is scenario.country_factors:
+                break
+        else:
+            index = len(factor_tables)
+            factor_tables.append(scenario.country_factors)
+        table_indexes.append(index)
+    factors = numpy.array([relay_country_factors(table, country_factors)
+                           for country_factors in factor_tables]).reshape(len(factor_tables), len(table))
+    amounts = numpy.array([scenario.amount for scenario in scenarios], dtype=float)
+    caps = numpy.array([scenario.cap for scenario in scenarios], dtype=float)
+    frac = table.bandwidth / float(table.bandwidth.sum())
+    relay_supports = amounts[:, numpy.newaxis] * frac * factors[table_indexes]
+    return numpy.minimum(relay_supports.dot(partner_membership(table)), caps[:, numpy.newaxis])
+
+def partner_membership(table):
+    """Return the relays × partners matrix with a 1 where the relay
+    belongs to the partner."""
+    membership = numpy.zeros((len(table), len(table.partners)))
+    membership[numpy.arange(len(table)), table.partner] = 1
+    return membership
+
+def bootstrap_supports(table, samples, monthly_amount, country_factors,
+                       resamples=BOOTSTRAP_RESAMPLES, seed=0):
+    """Return a partners × 2 array with the bounds of the 95% confidence
+    interval of each partner's support, estimated from `samples`, the
+    tallies of the sampled consensuses.
+
+    Sampled consensuses are drawn with replacement `resamples` times, and
+    supports are computed for each draw."""
+    rows = dict((fingerprint, row) for row, fingerprint in enumerate(table.fingerprint))
+    bandwidths = numpy.zeros((len(samples), len(table)))
+    for sample, tallies in enumerate(samples):
+        for fingerprint, (bandwidth, _) in tallies.iteritems():
+            if fingerprint in rows:
+                bandwidths[sample, rows[fingerprint]] = bandwidth
+    random = numpy.random.RandomState(seed)
+    draws = random.multinomial(len(samples), [1.0 / len(samples)] * len(samples), size=resamples)
+    sums = draws.dot(bandwidths)
+    totals = sums.sum(axis=1)[:, numpy.newaxis]
+    totals[totals == 0] = 1
+    relay_supports = monthly_amount * sums / totals * relay_country_factors(table, country_factors)
+    supports = numpy.minimum(relay_supports.dot(partner_membership(table)), MAX_MONTHLY_FINANCIAL_SUPPORT)
+    return numpy.percentile(supports, [2.5, 97.5], axis=0).T
+
+class SharedInputs(object):
+    """What processors read besides metrics archives: partners, country
+    factors and GeoIP databases. Each is loaded on first use, so
+    processors of a batch sharing the same SharedInputs only load them
+    once."""
+    def __init__(self, geoip_dir=GEOIP_DIR):
+        self.geoip_dir = geoip_dir
+        self._partners_info = None
+        self._country_factors = None
+        self._digests = None
+        # Dictionary of geoip file paths → GeoIPDatabase
+        self._geoip_databases = {}
+        # Dictionary of path → country factors of what-if scenarios
+        self._factor_files = {}
+
+    @property
+    def partners_info(self):
+        if self._partners_info is None:
+            self._partners_info = yaml.safe_load(file(PARTNERS_FILE))
+        return self._partners_info
+
+    @property
+    def country_factors(self):
+        if self._country_factors is None:
+            self._country_factors = yaml.safe_load(open(COUNTRY_FACTORS_FILE))
+        return self._country_factors
+
+    def factors_file(self, path):
+        """Return the country factors read from `path`."""
+        if path not in self._factor_files:
+            self._factor_files[path] = yaml.safe_load(open(path))
+        return self._factor_files[path]
+
+    @property
+    def digests(self):
+        if self._digests is None:
+            self._digests = {'partners': file_digest(PARTNERS_FILE),
+                             'country_factors': file_digest(COUNTRY_FACTORS_FILE)}
+        return self._digests
+
+    def geoip(self, month):
+        """Return the GeoIPDatabase to use for `month`, or None if no geoip
+        file can be found."""
+        paths = find_geoip_files(self.geoip_dir, month)
+        if not paths:
+            return None
+        key = tuple(paths)
+        if key not in self._geoip_databases:
+            print >>sys.stderr, "Using GeoIP database %s." % (os.path.dirname(paths[0]),)
+            self._geoip_databases[key] = GeoIPDatabase.load(*paths)
+        return self._geoip_databases[key]
+
+    def preload(self, months):
+        """Load everything needed for `months`, e.g. before forking
+        workers."""
+        self.partners_info, self.country_factors, self.digests
+        for month in months:
+            self.geoip(month)
 
 class ExitFundingProcessor(object):
-    def __init__(self, month, monthly_amount):
-        self.month = month
+    def __init__(self, period, monthly_amount, jobs=1, stream=False, geoip_dir=GEOIP_DIR, stats=None,
+                 inputs=None, base_url=COLLECTOR_URL, sample=None, tolerance=SAMPLE_TOLERANCE):
+        # Either a month (YYYY-MM) or a range of days, see parse_period()
+        self.period = period
+        self.start, self.end = parse_period(period)
+        self.months = months_between(self.start, self.end)
         self.monthly_amount = monthly_amount
+        # Number of worker processes used to parse archives
+        self.jobs = jobs
+        # Parse archives while downloading them instead of storing them
+        self.stream = stream
+        # Where archives are downloaded from: CollecTor or a mirror
+        self.base_url = base_url
+        # Only parse one consensus every `sample` hours and estimate the
+        # results, see parse_sampled_consensuses()
+        self.sample = sample
+        # Width in euros of the confidence interval under which a sampled
+        # support is deemed close enough to the one of a full run
+        self.tolerance = tolerance
+        # Tallies of each sampled consensus
+        self.samples = None
+        # Number of consensuses in the period, sampled or not
+        self.consensuses_seen = None
+        # numpy array of partners × (low, high) bounds of the 95%
+        # confidence interval of each support, when sampling
+        self.support_intervals = None
         self.country_factors = None
+        # Partners, country factors and GeoIP databases, possibly shared
+        # with other processors
+        self.inputs = inputs or SharedInputs(geoip_dir)
+        # Directory searched for Tor geoip files, see find_geoip_files()
+        self.geoip_dir = self.inputs.geoip_dir
+        # GeoIPDatabase, loaded when the first lookup is made
+        self.geoip = None
         # Stem Controller, used to perform GeoIP lookup against Tor database
-        self.controller = Controller.from_port(port=9151)
-        self.controller.authenticate()
+        # when no geoip file can be found
+        self.controller = None
         # Dictionary of partner_id → Partner object
         self.partners = None
-        # Dictionary of contact string → Partner object
+        # ContactMatcher giving the partner_id of relay contacts
         self.contacts = None
         # Dictionary of relay fingerprint → Relay object
         self.relays = None
+        # RelayRegistry, opened when first needed
+        self.registry = None
+        # RelayTable built from the relays, or loaded from the cache
+        self.table = None
+        # numpy arrays of financial support, indexed like the rows and
+        # partners of the table
+        self.relay_supports = None
+        self.partner_supports = None
+        # Stats of this run
+        self.stats = stats or Stats()
+        # Dictionary of archive path → ArchiveFeed of archives being
+        # downloaded, see download_data()
+        self.feeds = {}
 
     def process_metrics(self):
-        cached = self.load_cache()
+        if self.sample:
+            # Estimates are neither read from nor written to the cache
+            self.load_partners()
+            with self.stats.stage('download'):
+                self.download_data()
+            self.parse_metrics()
+            self.table = RelayTable.from_partners(self.partners)
+            return
+        with self.stats.stage('load cache'):
+            cached = self.load_cache()
         if not cached:
             self.load_partners()
-            self.download_data()
+            with self.stats.stage('download'):
+                self.download_data()
             self.parse_metrics()
-            self.save_cache()
+            with self.stats.stage('save cache'):
+                self.table = RelayTable.from_partners(self.partners)
+                self.save_cache()
 
     def load_partners(self):
         self.partners = {}
-        self.contacts = {}
-        for partner_id, info in yaml.safe_load(file(PARTNERS_FILE)).iteritems():
+        self.contacts = ContactMatcher()
+        for partner_id, info in self.inputs.partners_info.iteritems():
             partner = Partner(info)
             self.partners[partner_id] = partner
             for contact in partner.contacts:
-                self.contacts[contact] = partner
+                self.contacts.add(partner_id, contact)
 
     def download_data(self):
-        for path in [self.descriptors_path, self.consensuses_path]:
+        # Relays of months already in the registry are known: their
+        # server descriptors are not needed.
+        registry = self.open_registry()
+        paths = [self.descriptors_path(month) for month in self.months
+                 if not registry.has_month(month, self.descriptors_path(month))] + \
+                [self.consensuses_path(month) for month in self.months]
+        missing = []
+        for path in paths:
             if not os.path.exists(path):
-                download_metrics_archive(path)
+                if self.stream:
+                    continue # will be parsed while downloading
+                missing.append(path)
             else:
                 print >>sys.stderr, "%s already present. Skipping download." % (os.path.basename(path),)
+        if not missing:
+            return
+        downloader = ArchiveDownloader(ARCHIVE_DIR, self.base_url)
+        if self.jobs > 1:
+            # Workers need the complete archives
+            downloader.download_all(missing)
+            return
+        # Parse archives while they are downloaded. Consensuses wait for
+        # their turn until server descriptors have all been parsed.
+        for path in missing:
+            self.feeds[path] = ArchiveFeed(path, downloader)
+            self.feeds[path].start()
+
+    def descriptors_path(self, month):
+        return os.path.join(ARCHIVE_DIR, 'server-descriptors', 'server-descriptors-%s.tar') % (month,)
+
+    def consensuses_path(self, month):
+        return os.path.join(ARCHIVE_DIR, 'consensuses', 'consensuses-%s.tar') % (month,)
 
     @property
-    def descriptors_path(self):
-        return os.path.join(ARCHIVE_DIR, 'server-descriptors', 'server-descriptors-%s.tar') % (self.month,)
+    def cache_path(self):
+        return os.path.join(ARCHIVE_DIR, 'exit-funding-%s.cache') % (self.period,)
 
     @property
-    def consensuses_path(self):
-        return os.path.join(ARCHIVE_DIR, 'consensuses', 'consensuses-%s.tar') % (self.month,)
+    def shards_dir(self):
+        return os.path.join(ARCHIVE_DIR, 'shards')
 
     @property
-    def cache_path(self):
-        return os.path.join(ARCHIVE_DIR, 'exit-funding-%s.pickle') % (self.month,)
+    def registry_path(self):
+        return os.path.join(ARCHIVE_DIR, 'relays.sqlite')
+
+    def open_registry(self):
+        if self.registry is None:
+            if not os.path.exists(ARCHIVE_DIR):
+                os.mkdir(ARCHIVE_DIR)
+            self.registry = RelayRegistry(self.registry_path)
+        return self.registry
+
+    @property
+    def country_factors_path(self):
+        return os.path.join(ARCHIVE_DIR, 'country-factors-%s.yaml') % (self.period,)
+
+    def load_geoip(self):
+        self.geoip = self.inputs.geoip(self.months[0])
+        if self.geoip is None:
+            print >>sys.stderr, "No GeoIP database found. Asking Tor on port 9151."
+            self.controller = Controller.from_port(port=9151)
+            self.controller.authenticate()
 
     def get_country(self, address):
+        if self.geoip is None and self.controller is None:
+            self.load_geoip()
+        if self.geoip:
+            return self.geoip.get_country(address)
         return self.controller.get_info('ip-to-country/%s' % address)
 
+    def load_relays(self):
+        """Create a Relay for each relay of the registry that published a
+        descriptor with a partner contact during the months of the period.
+        Countries are looked up for the runs where it was not done yet."""
+        registry = self.open_registry()
+        start = parse_period(self.months[0])[0]
+        end = parse_period(self.months[-1])[1]
+        looked_up = []
+        runs = registry.runs(str(start), str(end))
+        for fingerprint, relay_runs in itertools.groupby(runs, key=lambda run: run.fingerprint):
+            relay_runs = list(relay_runs)
+            matching = [run for run in relay_runs if self.contacts.match(run.contact) is not None]
+            if not matching:
+                continue
+            countries = []
+            for run in relay_runs:
+                if run.country is None:
+                    run = run._replace(country=self.get_country(run.address))
+                    looked_up.append(run)
+                if not countries or countries[-1][1] != run.country:
+                    countries.append((run.valid_from, run.country))
+            first = matching[0]
+            relay = Relay(fingerprint, first.nickname, country_at(countries, first.valid_from), countries)
+            self.relays[fingerprint] = relay
+            self.partners[self.contacts.match(first.contact)].relays.append(relay)
+        if looked_up:
+            registry.set_countries(looked_up)
+
+    def open_tar(self, path):
+        if not os.path.exists(path) and self.stream:
+            return StreamedTarFile(metrics_archive_url(path, ARCHIVE_DIR, self.base_url))
+        return closing(TarFile(path))
+
+    @contextmanager
+    def open_contents(self, path, wanted=None):
+        """Return the content of every member of an archive, from its
+        ArchiveFeed if it is being downloaded.
+
+        Archives already downloaded are read through their TarIndex:
+        consensuses with a valid-after time for which `wanted` is false
+        are then skipped without being read."""
+        if path in self.feeds:
+            with self.feeds.pop(path) as contents:
+                yield contents
+            return
+        if os.path.exists(path):
+            yield read_members(path, TarIndex.open(path).select(wanted))
+            return
+        with self.open_tar(path) as tar:
+            yield iter_tar_contents(tar)
+
     def parse_descriptors(self):
-        with VerboseDescriptorReader([self.descriptors_path]) as reader:
-            for relay_desc in reader:
-                if relay_desc.contact in self.contacts:
-                    partner = self.contacts[relay_desc.contact]
-                    if not relay_desc.fingerprint in self.relays:
-                        relay = Relay(self, relay_desc)
-                        self.relays[relay_desc.fingerprint] = relay
-                        partner.relays.append(relay)
-
-    def parse_consensuses(self,):
-        with VerboseDescriptorReader([self.consensuses_path]) as reader:
-            for status_entry in reader:
-                if status_entry.fingerprint in self.relays:
-                    self.relays[status_entry.fingerprint].record_status_entry_bandwidth(status_entry)
+        """Add the server descriptors of the months not in the registry yet,
+        then find the relays of partners in the registry."""
+        registry = self.open_registry()
+        for month in self.months:
+            path = self.descriptors_path(month)
+            if registry.has_month(month, path):
+                print >>sys.stderr, "Relays of %s already known. Skipping server descriptors." % (month,)
+                continue
+            # Workers need random access to the archive, so streamed archives
+            # are always parsed by a single process.
+            if self.jobs > 1 and os.path.exists(path):
+                self.parse_descriptors_in_parallel(month, path)
+                continue
+            with self.open_contents(path) as contents:
+                registry.import_month(month, descriptor_records(count_documents(contents, path, self.stats)),
+                                      path)
+        self.load_relays()
+
+    def parse_sampled_consensuses(self):
+        """Tally one consensus every `self.sample` hours, and record bandwidth
+        scaled up to the number of consensuses in the period. The tallies
+        of each consensus are kept in `self.samples` to compute confidence
+        intervals later.
+
+        Shards are not used, and archives are always parsed by a single
+        process: only the sampled consensuses are actually parsed."""
+        selector = ConsensusSelector(self.start, self.end, set(), every=self.sample)
+        fingerprints = frozenset(self.relays)
+        self.samples = []
+        self.consensuses_seen = 0
+        for month in self.months:
+            path = self.consensuses_path(month)
+            with self.open_contents(path, selector.in_period) as contents:
+                for content in count_documents(contents, path, self.stats):
+                    valid_after = consensus_valid_after(content)
+                    if not selector.in_period(valid_after):
+                        continue
+                    self.consensuses_seen += 1
+                    if selector.sampled(valid_after):
+                        self.samples.append(tally_consensus(content, fingerprints, self.stats.counters))
+        if not self.samples:
+            return
+        scale = self.consensuses_seen / float(len(self.samples))
+        totals = {}
+        for tallies in self.samples:
+            for fingerprint, (bandwidth, status_entries_seen) in tallies.iteritems():
+                total = totals.setdefault(fingerprint, [0, 0])
+                total[0] += bandwidth
+                total[1] += status_entries_seen
+        for fingerprint, (bandwidth, status_entries_seen) in totals.iteritems():
+            self.relays[fingerprint].record_tally((int(round(bandwidth * scale)), status_entries_seen))
+
+    def parse_consensuses(self):
+        if self.sample:
+            self.parse_sampled_consensuses()
+            return
+        # Consensus bandwidth is aggregated in per-day shards, written
+        # after each consensus. An interrupted run resumes where it
+        # stopped, and only consensuses not aggregated yet are parsed.
+        days = days_between(self.start, self.end)
+        # Exit probabilities by country are computed in the same pass,
+        # but only with a GeoIP database: asking Tor for every exit of
+        # every consensus would take ages.
+        geoip = self.inputs.geoip(self.months[0])
+        countries = dict((fingerprint, relay.countries) for fingerprint, relay in self.relays.iteritems())
+        shards = BandwidthShards(self.shards_dir, countries, probabilities=geoip is not None)
+        selector = ConsensusSelector(self.start, self.end, shards.aggregated(days))
+        if selector.aggregated:
+            print >>sys.stderr, "%d consensuses already aggregated." % (len(selector.aggregated),)
+        for month in self.months:
+            path = self.consensuses_path(month)
+            if self.jobs > 1 and os.path.exists(path):
+                self.parse_consensuses_in_parallel(path, shards, selector, geoip)
+                continue
+            with self.open_contents(path, selector.wanted) as contents:
+                for content in count_documents(contents, path, self.stats):
+                    valid_after = consensus_valid_after(content)
+                    if not selector.wanted(valid_after):
+                        continue
+                    probabilities = country_exit_probabilities(content, geoip) if geoip else None
+                    shards.add(valid_after, tally_consensus(content, shards.fingerprints,
+                                                            self.stats.counters), probabilities)
+                    shards.flush()
+        for fingerprint, tallies in shards.sum(days).iteritems():
+            for country, tally in tallies.iteritems():
+                self.relays[fingerprint].record_tally(tally, country)
+        if geoip:
+            self.write_country_factors(shards.exit_probabilities(days))
+        else:
+            print >>sys.stderr, "No GeoIP database found. Country factors not computed."
+
+    def write_country_factors(self, consensuses):
+        matrix = ProbabilityMatrix.from_consensuses(consensuses)
+        if not matrix.valid_afters:
+            return
+        # Partners may run relays where no exit was seen: these countries
+        # need a factor too.
+        countries = set(relay.country for relay in self.relays.itervalues())
+        write_country_factors(self.country_factors_path,
+                              average_factors(matrix, z_score_factors, countries))
+        print >>sys.stderr, "Country factors from %d consensuses written to %s." % (
+                len(matrix.valid_afters), self.country_factors_path)
+
+    def map_tar_chunks(self, func, path, extra, ordered=True, wanted=None):
+        """Run `func` on chunks of the archive in worker processes and
+        return their results. `func` gets (path, chunk) and returns a
+        result and a Counter which is added to the stats. `extra` is
+        available to every worker as `chunk_extra`. Consensuses for which
+        `wanted` is false are left out, see TarIndex.select()."""
+        # Use more chunks than workers so a slow chunk does not leave
+        # every other worker idle at the end.
+        chunks = split_members(TarIndex.open(path).select(wanted), self.jobs * 4)
+        progress = Progress("%%d/%d chunks of %s parsed…" % (len(chunks), os.path.basename(path)))
+        pool = multiprocessing.Pool(self.jobs, initializer=init_chunk_worker, initargs=(extra,))
+        try:
+            mapper = pool.imap if ordered else pool.imap_unordered
+            for done, (result, counters) in enumerate(mapper(func, [(path, chunk) for chunk in chunks])):
+                progress.update(done + 1)
+                self.stats.counters.update(counters)
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        progress.done(len(chunks))
+        self.stats.add_documents(path, sum(len(chunk) for chunk in chunks))
+
+    def parse_descriptors_in_parallel(self, month, path):
+        records = self.map_tar_chunks(scan_descriptors, path, None, ordered=False)
+        self.open_registry().import_month(month, itertools.chain.from_iterable(records), path)
+
+    def parse_consensuses_in_parallel(self, path, shards, selector, geoip):
+        extra = (shards.fingerprints, selector, geoip)
+        for results in self.map_tar_chunks(tally_consensuses, path, extra, ordered=False,
+                                           wanted=selector.wanted):
+            for valid_after, tallies, probabilities in results:
+                shards.add(valid_after, tallies, probabilities)
+            shards.flush()
 
     def parse_metrics(self):
         self.relays = {}
-        self.parse_descriptors()
-        self.parse_consensuses()
+        with self.stats.stage('parse descriptors'):
+            self.parse_descriptors()
+        with self.stats.stage('parse consensuses'):
+            self.parse_consensuses()
 
     def load_country_factors(self):
-        self.country_factors = yaml.safe_load(open(COUNTRY_FACTORS_FILE))
+        self.country_factors = self.inputs.country_factors
+
+    def sweep_supports(self, what_ifs):
+        """Return the scenarios × partners matrix of financial support for
+        a list of (amount, cap, country factors file)."""
+        scenarios = [Scenario(amount, cap, self.inputs.factors_file(factors_path))
+                     for amount, cap, factors_path in what_ifs]
+        return sweep_supports(self.table, scenarios)
 
     def compute_total_bandwidths(self):
-        grand_total = 0
-        for partner in self.partners.itervalues():
-            partner.patch()
-            partner.total_bandwidth = 0
-            for relay in partner.relays:
-                relay.patch()
-                partner.total_bandwidth += relay.total_reported_bandwidth
-            grand_total += partner.total_bandwidth
-        return grand_total
+        return int(self.table.bandwidth.sum())
 
     def compute_supports(self):
         self.load_country_factors()
+        table = self.table
         total_partners_bandwidth = self.compute_total_bandwidths()
-        for partner in self.partners.itervalues():
-            partner.support = 0
-            for relay in partner.relays:
-                frac = relay.total_reported_bandwidth / float(total_partners_bandwidth)
-                relay.support = self.monthly_amount * frac * self.country_factors[relay.country]
-                partner.support += relay.support
-            partner.support = min(partner.support, MAX_MONTHLY_FINANCIAL_SUPPORT)
+        frac = table.bandwidth / float(total_partners_bandwidth)
+        self.relay_supports = self.monthly_amount * frac * relay_country_factors(table, self.country_factors)
+        self.partner_supports = numpy.minimum(
+                numpy.bincount(table.partner, weights=self.relay_supports, minlength=len(table.partners)),
+                MAX_MONTHLY_FINANCIAL_SUPPORT)
+        if self.samples:
+            self.support_intervals = bootstrap_supports(table, self.samples, self.monthly_amount,
+                                                        self.country_factors)
 
     def print_results(self):
-        partners = self.partners.values()
-        partners.sort(key=operator.attrgetter('support'), reverse=True)
+        table = self.table
+        partners = range(len(table.partners))
+        partners.sort(key=self.partner_supports.__getitem__, reverse=True)
         for partner in partners:
-            mark = "=" * ((TERM_WIDTH - len(partner.name) - 1) / 2)
-            print "%s %s %s" % (mark, partner.name, mark)
+            name = table.partner_names[partner]
+            mark = "=" * ((TERM_WIDTH - len(name) - 1) / 2)
+            print "%s %s %s" % (mark, name, mark)
             t = PrettyTable(['Relay', 'Exit bandwidth', 'Country', 'Financial support'])
             t.align['Exit bandwidth'] = 'r'
             t.align['Financial support'] = 'r'
-            relays = list(partner.relays)
-            relays.sort(key=operator.attrgetter('support'), reverse=True)
+            relays = list(numpy.flatnonzero(table.partner == partner))
+            relays.sort(key=self.relay_supports.__getitem__, reverse=True)
             for relay in relays:
-                t.add_row([relay.nickname,
-                           "%0.02f Mbit/s" % (relay.total_reported_bandwidth * 8 / 1000000.0,),
-                           relay.country, "%0.02f €" % relay.support])
+                t.add_row([table.nicknames[table.nickname[relay]],
+                           "%0.02f Mbit/s" % (table.bandwidth[relay] * 8 / 1000000.0,),
+                           table.countries[table.country[relay]],
+                           "%0.02f €" % self.relay_supports[relay]])
             print t
-            print "Financial support: %0.02f €" % (partner.support,)
+            print "Financial support: %0.02f €" % (self.partner_supports[partner],)
             print ""
 
+    def print_what_ifs(self, what_ifs):
+        supports = self.sweep_supports(what_ifs)
+        labels = ["%d, max. %d, %s" % (amount, cap, os.path.basename(factors_path))
+                  for amount, cap, factors_path in what_ifs]
+        t = PrettyTable(['Partner'] + labels)
+        t.align['Partner'] = 'l'
+        for label in labels:
+            t.align[label] = 'r'
+        for partner, name in enumerate(self.table.partner_names):
+            t.add_row([name] + ["%0.02f €" % support for support in supports[:, partner]])
+        print "What if…"
+        print t
+
+    def within_tolerance(self):
+        """Return a boolean array telling for each partner if the confidence
+        interval of its sampled support is narrower than the tolerance."""
+        low, high = self.support_intervals.T
+        return high - low <= self.tolerance
+
+    def print_estimates(self):
+        within_tolerance = self.within_tolerance()
+        t = PrettyTable(['Partner', 'Estimated support', '95% interval', 'Within tolerance'])
+        t.align['Partner'] = 'l'
+        t.align['Estimated support'] = 'r'
+        t.align['95% interval'] = 'r'
+        for partner, name in enumerate(self.table.partner_names):
+            low, high = self.support_intervals[partner]
+            t.add_row([name,
+                       "%0.02f €" % (self.partner_supports[partner],),
+                       "%0.02f – %0.02f €" % (low, high),
+                       "yes" if within_tolerance[partner] else "no"])
+        print "Estimated from %d of %d consensuses (one every %d hours)" % (
+                len(self.samples), self.consensuses_seen, self.sample)
+        print t
+        if within_tolerance.all():
+            print "Every estimate is within %g € of what a full run should give." % (self.tolerance,)
+        else:
+            print "Some estimates are not within %g €: sample more consensuses." % (self.tolerance,)
+
+    def input_digests(self):
+        """Return what the cache depends on, besides the code: partners and
+        country factors, the archives, the months imported in the registry
+        and the GeoIP files."""
+        digests = dict(self.inputs.digests)
+        for name, archive_path in [('consensuses', self.consensuses_path),
+                                   ('descriptors', self.descriptors_path)]:
+            digests[name] = [archive_signature(path) if os.path.exists(path) else None
+                             for path in map(archive_path, self.months)]
+        registry = self.open_registry()
+        digests['registry'] = [registry.month_signature(month) for month in self.months]
+        geoip_paths = find_geoip_files(self.geoip_dir, self.months[0]) or []
+        digests['geoip'] = [[path, int(os.path.getmtime(path))] for path in geoip_paths if path]
+        return digests
+
     def load_cache(self):
         if not os.path.exists(self.cache_path):
             return False
-        d = pickle.load(file(self.cache_path))
-        self.partners = d['partners']
-        self.contacts = d['contacts']
-        self.relays = d['relays']
+        try:
+            self.table = RelayTable.load(self.cache_path, self.input_digests())
+        except StaleCacheError, e:
+            print >>sys.stderr, "Ignoring stale cache %s: %s." % (os.path.basename(self.cache_path), e)
+            return False
         return True
 
     def save_cache(self):
-        with file(self.cache_path, 'w') as f:
-            try:
-                pickle.dump({'partners': self.partners,
-                             'contacts': self.contacts,
-                             'relays': self.relays}, f)
-            except:
-                try:
-                    os.unlink(self.cache_path)
-                except OSError:
-                    pass # files has not been created, also good
-                raise
-
-def usage():
-    print >>sys.stderr, "Usage: %s YYYY-MM MONTHLY_AMOUNT" % sys.argv[0]
+        if not os.path.exists(ARCHIVE_DIR):
+            os.mkdir(ARCHIVE_DIR)
+        self.table.save(self.cache_path, self.input_digests())
 
-def main():
-    if len(sys.argv) < 3:
-        usage()
-        sys.exit(1)
+# SharedInputs of a batch, inherited by its worker processes
+batch_inputs = None
+
+def init_batch_worker(inputs):
+    global batch_inputs
+    batch_inputs = inputs
+
+def process_month(args):
+    """Worker: parse the metrics of a month of a batch and write its cache.
+    Return the month and the Stats."""
+    month, monthly_amount, stream, base_url = args
+    processor = ExitFundingProcessor(month, monthly_amount, stream=stream, inputs=batch_inputs,
+                                     base_url=base_url)
+    processor.process_metrics()
+    return month, processor.stats
+
+class BatchProcessor(object):
+    """Compute financial support for a range of months, each processed as
+    if given alone, and sharing partners, GeoIP databases and country
+    factors."""
+    def __init__(self, months, monthly_amount, jobs=1, stream=False, geoip_dir=GEOIP_DIR,
+                 base_url=COLLECTOR_URL):
+        self.months = months
+        self.monthly_amount = monthly_amount
+        # Number of months processed at the same time. When a single
+        # month has to be processed, its archives are parsed with that
+        # many processes instead.
+        self.jobs = jobs
+        self.stream = stream
+        self.base_url = base_url
+        self.inputs = SharedInputs(geoip_dir)
+        self.stats = Stats()
+        # Dictionary of month → ExitFundingProcessor
+        self.processors = collections.OrderedDict(
+                (month, ExitFundingProcessor(month, monthly_amount, jobs=jobs, stream=stream,
+                                             inputs=self.inputs, base_url=base_url))
+                for month in months)
+
+    def process_metrics(self):
+        pending = []
+        for month, processor in self.processors.iteritems():
+            with processor.stats.stage('load cache'):
+                cached = processor.load_cache()
+            if not cached:
+                pending.append(month)
+        if len(pending) == 1 or self.jobs == 1:
+            for month in pending:
+                self.processors[month].process_metrics()
+        elif pending:
+            self.process_in_parallel(pending)
+        for processor in self.processors.itervalues():
+            self.stats.merge(processor.stats)
+
+    def compute_supports(self):
+        for processor in self.processors.itervalues():
+            processor.compute_supports()
+
+    def process_in_parallel(self, months):
+        # Workers are forked after everything is loaded, so they all use
+        # the parent copy instead of loading their own.
+        self.inputs.preload(months)
+        pool = multiprocessing.Pool(min(self.jobs, len(months)),
+                                    initializer=init_batch_worker, initargs=(self.inputs,))
+        try:
+            tasks = [(month, self.monthly_amount, self.stream, self.base_url) for month in months]
+            for month, stats in pool.imap_unordered(process_month, tasks):
+                print >>sys.stderr, "%s processed." % (month,)
+                processor = self.processors[month]
+                processor.stats.merge(stats)
+                if not processor.load_cache():
+                    raise RuntimeError("unable to read the cache written for %s" % (month,))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
-    month = sys.argv[1]
-    monthly_amount = int(sys.argv[2])
-    processor = ExitFundingProcessor(month, monthly_amount)
+    def print_results(self, what_ifs=()):
+        for month, processor in self.processors.iteritems():
+            mark = "#" * ((TERM_WIDTH - len(month) - 1) / 2)
+            print "%s %s %s" % (mark, month, mark)
+            print ""
+            processor.print_results()
+            if what_ifs:
+                processor.print_what_ifs(what_ifs)
+                print ""
+        self.print_totals()
+
+    def print_totals(self):
+        names = {}
+        supports = collections.defaultdict(dict)
+        for month, processor in self.processors.iteritems():
+            table = processor.table
+            for partner, partner_id in enumerate(table.partners):
+                names[partner_id] = table.partner_names[partner]
+                supports[partner_id][month] = processor.partner_supports[partner]
+        totals = dict((partner_id, sum(supports[partner_id].itervalues())) for partner_id in names)
+        t = PrettyTable(['Partner'] + self.months + ['Total'])
+        t.align['Partner'] = 'l'
+        for column in self.months + ['Total']:
+            t.align[column] = 'r'
+        for partner_id in sorted(names, key=totals.get, reverse=True):
+            t.add_row([names[partner_id]] +
+                      ["%0.02f €" % supports[partner_id].get(month, 0) for month in self.months] +
+                      ["%0.02f €" % totals[partner_id]])
+        print "Financial support from %s to %s" % (self.months[0], self.months[-1])
+        print t
+        print "Total: %0.02f €" % (sum(totals.itervalues()),)
+
+def period_cache(args):
+    """Return the PeriodCache for --serve."""
+    inputs = SharedInputs(args.geoip_dir)
+    def process(period):
+        processor = ExitFundingProcessor(period, 0, jobs=args.jobs, stream=args.stream,
+                                         inputs=inputs, base_url=args.base_url)
+        processor.process_metrics()
+        return processor
+    return PeriodCache(args.keep, process)
+
+def period_type(period):
+    try:
+        batch_months(period) or parse_period(period)
+    except ValueError, e:
+        raise argparse.ArgumentTypeError(str(e))
+    return period
+
+def what_if_type(what_if):
+    """Parse AMOUNT[:CAP[:FACTORS_FILE]]."""
+    fields = what_if.split(':', 2)
+    try:
+        amount = int(fields[0])
+        cap = int(fields[1]) if len(fields) > 1 and fields[1] else MAX_MONTHLY_FINANCIAL_SUPPORT
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid scenario: %s" % (what_if,))
+    factors_path = fields[2] if len(fields) > 2 else COUNTRY_FACTORS_FILE
+    return amount, cap, factors_path
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Compute financial support for torservers.net partner organizations.')
+    parser.add_argument('period', metavar='YYYY-MM', type=period_type, nargs='?',
+            help='month for which the computation must be done, a range '
+                 'of days given as YYYY-MM-DD..YYYY-MM-DD, or a range of '
+                 'months given as YYYY-MM..YYYY-MM')
+    parser.add_argument('monthly_amount', metavar='MONTHLY_AMOUNT', type=int, nargs='?',
+            help='amount of euros shared between partner organizations')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of processes used to parse archives, or to process '
+                 'months of a range of months (default: 1)')
+    parser.add_argument('--stream', action='store_true',
+            help='parse missing archives while downloading them instead of '
+                 'storing them uncompressed')
+    parser.add_argument('--mirror', metavar='URL', dest='base_url', default=COLLECTOR_URL,
+            help='where to download relay descriptor archives from (default: %(default)s)')
+    parser.add_argument('--geoip-dir', default=GEOIP_DIR,
+            help='directory holding Tor geoip files (default: %(default)s)')
+    parser.add_argument('--what-if', metavar='AMOUNT[:CAP[:FACTORS_FILE]]',
+            type=what_if_type, action='append', default=[],
+            help='also show what the support would be with another amount, '
+                 'maximum support and country factors file (can be repeated)')
+    parser.add_argument('--sample', metavar='N', type=int,
+            help='quick estimate: only parse one consensus every N hours, '
+                 'and show confidence intervals for each support')
+    parser.add_argument('--tolerance', metavar='EUROS', type=float, default=SAMPLE_TOLERANCE,
+            help='with --sample, widest confidence interval deemed close '
+                 'enough to a full run (default: %(default)s)')
+    parser.add_argument('--profile', metavar='FILE',
+            help='profile the run with cProfile and write the stats to FILE; '
+                 'worker processes are not profiled, use --jobs 1 to see '
+                 'everything')
+    parser.add_argument('--serve', metavar='PORT', type=int,
+            help='instead of computing support for a period, answer queries '
+                 'on http://127.0.0.1:PORT/, keeping recently queried periods '
+                 'in memory')
+    parser.add_argument('--keep', metavar='N', type=int, default=SERVED_PERIODS,
+            help='with --serve, number of periods kept in memory (default: %(default)s)')
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.serve is not None:
+        if args.keep < 1:
+            parser.error("--keep must be at least 1")
+        return args
+    if args.period is None or args.monthly_amount is None:
+        parser.error("YYYY-MM and MONTHLY_AMOUNT are required, unless --serve is given")
+    if args.sample is not None and args.sample < 1:
+        parser.error("--sample must be at least 1")
+    if args.sample and batch_months(args.period):
+        parser.error("--sample cannot be used with a range of months")
+    return args
+
+def run_batch(args, months):
+    batch = BatchProcessor(months, args.monthly_amount, jobs=args.jobs, stream=args.stream,
+                           geoip_dir=args.geoip_dir, base_url=args.base_url)
+    with batch.stats.stage('process metrics'):
+        batch.process_metrics()
+    with batch.stats.stage('compute supports'):
+        batch.compute_supports()
+    batch.print_results(args.what_if)
+    batch.stats.report()
+
+def run(args):
+    if args.serve is not None:
+        serve(QueryServer(('127.0.0.1', args.serve), period_cache(args), what_if_type,
+                          COUNTRY_FACTORS_FILE, ARCHIVE_DIR))
+        return
+    months = batch_months(args.period)
+    if months:
+        run_batch(args, months)
+        return
+    processor = ExitFundingProcessor(args.period, args.monthly_amount,
+                                     jobs=args.jobs, stream=args.stream,
+                                     geoip_dir=args.geoip_dir, base_url=args.base_url,
+                                     sample=args.sample, tolerance=args.tolerance)
     processor.process_metrics()
-    processor.compute_supports()
+    with processor.stats.stage('compute supports'):
+        processor.compute_supports()
     processor.print_results()
+    if processor.support_intervals is not None:
+        processor.print_estimates()
+    if args.what_if:
+        processor.print_what_ifs(args.what_if)
+    processor.stats.report()
+
+def main():
+    args = parse_args()
+    if not args.profile:
+        run(args)
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(args.profile)
+        print >>sys.stderr, "Profile written to %s. Most expensive calls:" % (args.profile,)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
 
 if __name__ == '__main__':
     main()
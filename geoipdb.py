@@ -0,0 +1,178 @@
+# -*- coding: utf8 -*-
+#
+# geoipdb.py: offline GeoIP lookups using Tor geoip files
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Answer the same questions as Tor's `ip-to-country` GETINFO without a
+running Tor.
+
+The `geoip` and `geoip6` files shipped with Tor are loaded once into
+sorted arrays of address ranges. Lookups are then a binary search.
+"""
+
+import array
+import binascii
+import bisect
+import os
+import os.path
+import re
+import socket
+import struct
+
+UNKNOWN_COUNTRY = '??'
+
+# Where Tor packages usually install their GeoIP files
+DEFAULT_GEOIP_DIRS = ['/usr/share/tor', '/usr/local/share/tor']
+
+def ipv4_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+def ipv6_to_int(address):
+    return int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, address)), 16)
+
+class AddressRanges(object):
+    """Sorted, non-overlapping ranges of integer addresses with the index
+    of their country."""
+    def __init__(self, typecode):
+        # IPv6 addresses do not fit in an array, plain lists are used then
+        self.starts = array.array(typecode) if typecode else []
+        self.ends = array.array(typecode) if typecode else []
+        self.countries = array.array('H')
+
+    def append(self, start, end, country_index):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.countries.append(country_index)
+
+    def sort(self):
+        order = sorted(xrange(len(self.starts)), key=self.starts.__getitem__)
+        for name in ['starts', 'ends', 'countries']:
+            values = getattr(self, name)
+            sorted_values = [values[i] for i in order]
+            if isinstance(values, array.array):
+                setattr(self, name, array.array(values.typecode, sorted_values))
+            else:
+                setattr(self, name, sorted_values)
+
+    def find(self, value):
+        """Return the country index for `value`, or None."""
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return self.countries[i]
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
+class GeoIPDatabase(object):
+    def __init__(self):
+        self._country_names = []
+        self._country_indexes = {}
+        self._ipv4 = AddressRanges('L')
+        self._ipv6 = AddressRanges(None)
+
+    @classmethod
+    def load(cls, geoip_path, geoip6_path=None):
+        db = cls()
+        with open(geoip_path) as f:
+            db._read(f, db._ipv4, long)
+        if geoip6_path:
+            with open(geoip6_path) as f:
+                db._read(f, db._ipv6, ipv6_to_int)
+        db._ipv4.sort()
+        db._ipv6.sort()
+        return db
+
+    def _country_index(self, country):
+        country = country.lower()
+        index = self._country_indexes.get(country)
+        if index is None:
+            index = len(self._country_names)
+            self._country_names.append(country)
+            self._country_indexes[country] = index
+        return index
+
+    def _read(self, f, ranges, to_int):
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            start, end, country = line.split(',')
+            ranges.append(to_int(start), to_int(end), self._country_index(country))
+
+    def __len__(self):
+        return len(self._ipv4) + len(self._ipv6)
+
+    def get_country(self, address):
+        """Return the lowercase country code for `address`, or '??' like
+        Tor does when it is unknown."""
+        address = address.strip('[]')
+        try:
+            if ':' in address:
+                index = self._ipv6.find(ipv6_to_int(address))
+            else:
+                index = self._ipv4.find(ipv4_to_int(address))
+        except (socket.error, ValueError):
+            return UNKNOWN_COUNTRY
+        if index is None:
+            return UNKNOWN_COUNTRY
+        return self._country_names[index]
+
+    def get_countries(self, addresses):
+        """Return a list of country codes for the given addresses.
+        Repeated addresses are only looked up once."""
+        seen = {}
+        countries = []
+        for address in addresses:
+            country = seen.get(address)
+            if country is None:
+                country = seen[address] = self.get_country(address)
+            countries.append(country)
+        return countries
+
+def find_geoip_files(geoip_dir, month=None):
+    """Return the paths of the `geoip` and `geoip6` files to use for the
+    given month, or None if there is none.
+
+    `geoip_dir` may contain a `YYYY-MM` subdirectory for every GeoIP
+    database release. The most recent one not newer than `month` is
+    the database that was in effect then. Otherwise, files directly in
+    `geoip_dir`, and then in the places Tor installs them, are used.
+    `geoip6` is optional and its path is None when absent."""
+    candidates = []
+    if geoip_dir and os.path.isdir(geoip_dir):
+        releases = [name for name in os.listdir(geoip_dir)
+                    if re.match(r'^\d{4}-\d{2}$', name)
+                    and os.path.exists(os.path.join(geoip_dir, name, 'geoip'))]
+        if month:
+            releases = [name for name in releases if name <= month]
+        candidates.extend(os.path.join(geoip_dir, name) for name in sorted(releases, reverse=True))
+        candidates.append(geoip_dir)
+    candidates.extend(DEFAULT_GEOIP_DIRS)
+    for directory in candidates:
+        geoip_path = os.path.join(directory, 'geoip')
+        if os.path.exists(geoip_path):
+            geoip6_path = os.path.join(directory, 'geoip6')
+            if not os.path.exists(geoip6_path):
+                geoip6_path = None
+            return geoip_path, geoip6_path
+    return None
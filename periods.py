@@ -0,0 +1,64 @@
+# -*- coding: utf8 -*-
+#
+# periods.py: periods of time computations are done for
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Periods of time: months, ranges of days and ranges of months, given
+as on the command line.
+"""
+
+import datetime
+import re
+
+def parse_period(period):
+    """Return the first day and the day after the last day of a period
+    given either as YYYY-MM or as YYYY-MM-DD..YYYY-MM-DD."""
+    match = re.match(r'^(\d{4})-(\d{2})$', period)
+    if match:
+        year, month = int(match.group(1)), int(match.group(2))
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + month / 12, month % 12 + 1, 1)
+        return start, end
+    match = re.match(r'^(\d{4}-\d{2}-\d{2})\.\.(\d{4}-\d{2}-\d{2})$', period)
+    if match:
+        start, last = [datetime.datetime.strptime(d, '%Y-%m-%d').date() for d in match.groups()]
+        if last >= start:
+            return start, last + datetime.timedelta(days=1)
+    raise ValueError("invalid period: %s" % (period,))
+
+def batch_months(period):
+    """Return the list of months of a batch given as YYYY-MM..YYYY-MM, or
+    None if `period` is not a batch."""
+    match = re.match(r'^(\d{4}-\d{2})\.\.(\d{4}-\d{2})$', period)
+    if not match:
+        return None
+    start = parse_period(match.group(1))[0]
+    end = parse_period(match.group(2))[1]
+    if end <= start:
+        raise ValueError("invalid period: %s" % (period,))
+    return months_between(start, end)
+
+def days_between(start, end):
+    return [str(start + datetime.timedelta(days=i)) for i in xrange((end - start).days)]
+
+def months_between(start, end):
+    return sorted(set(day[:7] for day in days_between(start, end)))
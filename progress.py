@@ -0,0 +1,45 @@
+# -*- coding: utf8 -*-
+#
+# progress.py: progress lines on stderr
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import sys
+import time
+
+# Minimum number of seconds between two progress lines
+PROGRESS_INTERVAL = 0.5
+
+class Progress(object):
+    """Rewrite a progress line on stderr, at most every PROGRESS_INTERVAL
+    seconds however often it is updated."""
+    def __init__(self, message):
+        self.message = message
+        self.last_shown = time.time()
+
+    def update(self, *values):
+        now = time.time()
+        if now - self.last_shown >= PROGRESS_INTERVAL:
+            self.last_shown = now
+            sys.stderr.write((self.message % values) + "\r")
+
+    def done(self, *values):
+        sys.stderr.write((self.message % values) + "\n")
@@ -0,0 +1,267 @@
+# -*- coding: utf8 -*-
+#
+# queryserver.py: answer JSON queries about financial support over HTTP
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Answer queries about the financial support of partners over HTTP,
+keeping the parsing results of the most recently queried periods in
+memory. See QueryHandler for the queries.
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import csv
+import fnmatch
+import json
+import os.path
+import sys
+import traceback
+import urlparse
+
+import numpy
+import yaml
+
+from periods import batch_months, parse_period
+
+class PeriodCache(object):
+    """Processors of the most recently queried periods, with their metrics
+    processed. Other periods are forgotten.
+
+    `process(period)` must return a new processor for the period, once
+    its metrics are processed."""
+    def __init__(self, size, process):
+        self.size = size
+        self.process = process
+        # Ordered dictionary of period → processor, least recently used
+        # first
+        self._processors = collections.OrderedDict()
+
+    def get(self, period):
+        """Return the processor of `period`, processing its metrics if it
+        is not in memory."""
+        processor = self._processors.pop(period, None)
+        if processor is None:
+            processor = self.process(period)
+            while len(self._processors) >= self.size:
+                self._processors.popitem(last=False)
+        self._processors[period] = processor
+        return processor
+
+    def periods(self):
+        return list(self._processors)
+
+class QueryError(Exception):
+    pass
+
+# Columns of per-relay results, in JSON queries and exports
+RELAY_FIELDS = ['fingerprint', 'nickname', 'country', 'partner', 'bandwidth', 'status_entries', 'support']
+
+def relay_rows(processor):
+    """Return a dictionary of RELAY_FIELDS for each row of the table."""
+    table = processor.table
+    for row in xrange(len(table)):
+        yield {'fingerprint': str(table.fingerprint[row]),
+               'nickname': table.nicknames[table.nickname[row]],
+               'country': table.countries[table.country[row]],
+               'partner': table.partners[table.partner[row]],
+               'bandwidth': int(table.bandwidth[row]),
+               'status_entries': int(table.status_entries[row]),
+               'support': round(float(processor.relay_supports[row]), 2)}
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer queries about the financial support of a period:
+
+        GET /periods
+        GET /PERIOD/partners?amount=N
+        GET /PERIOD/relays?amount=N[&partner=ID]
+        GET /PERIOD/what-if?scenario=AMOUNT[:CAP[:FACTORS_FILE]][&scenario=…]
+        GET /PERIOD/export.csv?amount=N
+        GET /PERIOD/export.json?amount=N
+
+    Answers are JSON, except for the CSV export. Exports are written one
+    relay at a time. Only the default factors file and the factors files
+    written in the archive directory can be used as FACTORS_FILE."""
+
+    server_version = 'exit-funding'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.query = urlparse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        try:
+            if parts == ['periods']:
+                self.send_json({'periods': self.server.periods.periods()})
+                return
+            if len(parts) != 2:
+                self.send_json({'error': 'not found'}, status=404)
+                return
+            period, action = parts
+            handler = {'partners': self.query_partners,
+                       'relays': self.query_relays,
+                       'what-if': self.query_what_if,
+                       'export.csv': self.export_csv,
+                       'export.json': self.export_json}.get(action)
+            if handler is None:
+                self.send_json({'error': 'not found'}, status=404)
+                return
+            if batch_months(period):
+                raise QueryError("ranges of months are not supported: %s" % (period,))
+            try:
+                parse_period(period)
+            except ValueError, e:
+                raise QueryError(str(e))
+            handler(self.server.periods.get(period))
+        except QueryError, e:
+            self.send_json({'error': str(e)}, status=400)
+        except Exception, e:
+            # E.g. a failed download: the client still gets an answer
+            traceback.print_exc()
+            self.send_json({'error': 'internal error: %s' % (e,)}, status=500)
+
+    def param(self, name, type=str, default=None):
+        values = self.query.get(name)
+        if not values:
+            if default is None:
+                raise QueryError("missing parameter: %s" % (name,))
+            return default
+        try:
+            return type(values[0])
+        except ValueError:
+            raise QueryError("invalid %s: %s" % (name, values[0]))
+
+    def compute_supports(self, processor):
+        processor.monthly_amount = self.param('amount', int)
+        processor.compute_supports()
+
+    def send_json(self, answer, status=200):
+        body = json.dumps(answer)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def query_partners(self, processor):
+        self.compute_supports(processor)
+        table = processor.table
+        bandwidths = numpy.bincount(table.partner, weights=table.bandwidth, minlength=len(table.partners))
+        relays = numpy.bincount(table.partner, minlength=len(table.partners))
+        self.send_json({'period': processor.period,
+                        'amount': processor.monthly_amount,
+                        'partners': [{'id': partner_id,
+                                      'name': table.partner_names[partner],
+                                      'support': round(float(processor.partner_supports[partner]), 2),
+                                      'bandwidth': int(bandwidths[partner]),
+                                      'relays': int(relays[partner])}
+                                     for partner, partner_id in enumerate(table.partners)]})
+
+    def query_relays(self, processor):
+        self.compute_supports(processor)
+        partner_id = self.param('partner', default='')
+        rows = [row for row in relay_rows(processor) if not partner_id or row['partner'] == partner_id]
+        self.send_json({'period': processor.period,
+                        'amount': processor.monthly_amount,
+                        'relays': rows})
+
+    def query_what_if(self, processor):
+        try:
+            what_ifs = [self.server.parse_scenario(scenario) for scenario in self.query.get('scenario', [])]
+        except argparse.ArgumentTypeError, e:
+            raise QueryError(str(e))
+        if not what_ifs:
+            raise QueryError("missing parameter: scenario")
+        for _, _, factors_path in what_ifs:
+            self.check_factors_file(processor, factors_path)
+        supports = processor.sweep_supports(what_ifs)
+        table = processor.table
+        self.send_json({'period': processor.period,
+                        'scenarios': [{'amount': amount, 'cap': cap, 'country_factors': factors_path}
+                                      for amount, cap, factors_path in what_ifs],
+                        'partners': [{'id': partner_id,
+                                      'name': table.partner_names[partner],
+                                      'supports': [round(float(support), 2) for support in supports[:, partner]]}
+                                     for partner, partner_id in enumerate(table.partners)]})
+
+    def check_factors_file(self, processor, path):
+        """Refuse factors files that cannot be used for the period."""
+        real_path = os.path.realpath(path)
+        if real_path != os.path.realpath(self.server.factors_file) and \
+           not (os.path.dirname(real_path) == os.path.realpath(self.server.archive_dir) and
+                fnmatch.fnmatch(os.path.basename(real_path), 'country-factors-*.yaml')):
+            raise QueryError("factors file not allowed: %s" % (path,))
+        try:
+            factors = processor.inputs.factors_file(path)
+        except (IOError, yaml.YAMLError), e:
+            raise QueryError("cannot read %s: %s" % (path, e))
+        if not isinstance(factors, dict):
+            raise QueryError("not a table of country factors: %s" % (path,))
+        missing = [country for country in processor.table.countries
+                   if not isinstance(factors.get(country), (int, float))]
+        if missing:
+            raise QueryError("no factor in %s for: %s" % (path, ', '.join(sorted(missing))))
+
+    def export_csv(self, processor):
+        self.compute_supports(processor)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.end_headers()
+        writer = csv.DictWriter(self.wfile, RELAY_FIELDS)
+        writer.writeheader()
+        for row in relay_rows(processor):
+            writer.writerow(row)
+
+    def export_json(self, processor):
+        self.compute_supports(processor)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write('[')
+        for index, row in enumerate(relay_rows(processor)):
+            self.wfile.write('%s\n%s' % (',' if index else '', json.dumps(row)))
+        self.wfile.write('\n]\n')
+
+class QueryServer(BaseHTTPServer.HTTPServer):
+    """Serve queries one at a time: a query about a period which is not
+    in memory takes long, but concurrent ones would process it twice.
+
+    `parse_scenario` turns AMOUNT[:CAP[:FACTORS_FILE]] into (amount, cap,
+    factors file), or raises argparse.ArgumentTypeError. FACTORS_FILE
+    defaults to `factors_file`, and the other allowed files are looked
+    for in `archive_dir`."""
+    def __init__(self, address, periods, parse_scenario, factors_file, archive_dir):
+        BaseHTTPServer.HTTPServer.__init__(self, address, QueryHandler)
+        # PeriodCache of the processors queried
+        self.periods = periods
+        self.parse_scenario = parse_scenario
+        self.factors_file = factors_file
+        self.archive_dir = archive_dir
+
+def serve(server):
+    """Answer queries until interrupted."""
+    print >>sys.stderr, "Answering queries on http://%s:%d/. Interrupt to stop." % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,219 @@
+# -*- coding: utf8 -*-
+#
+# relayregistry.py: what relays have been, month after month
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Keep track of every relay seen in server descriptors, in a SQLite
+database updated with the descriptors of each month.
+
+Each month remembers the signature of the archive it was imported from,
+and whether the archive covered the whole month: a month is imported
+again when its archive is replaced, or when a partial import is needed
+without the archive at hand.
+
+For each relay, the registry stores runs: the first and last time a
+descriptor was published with the same nickname, contact and address.
+A new run starts whenever one of them changes. The country of a run is
+only looked up when it is needed, and then remembered.
+
+Times are 'YYYY-MM-DD HH:MM:SS' strings, so they compare like dates.
+"""
+
+import calendar
+import collections
+import os.path
+import sqlite3
+import time
+
+from tarindex import archive_signature
+
+# A server descriptor, as far as the registry is concerned
+DescriptorRecord = collections.namedtuple('DescriptorRecord',
+        ['fingerprint', 'published', 'nickname', 'address', 'contact'])
+
+# A period where a relay kept the same nickname, contact and address
+Run = collections.namedtuple('Run',
+        ['fingerprint', 'valid_from', 'valid_until', 'nickname', 'contact', 'address', 'country'])
+
+# Run in a transaction, as other processes may create the tables too
+SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS months (
+    month TEXT PRIMARY KEY,
+    descriptors INTEGER NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS runs (
+    fingerprint TEXT NOT NULL,
+    valid_from TEXT NOT NULL,
+    valid_until TEXT NOT NULL,
+    nickname TEXT,
+    contact TEXT,
+    address TEXT,
+    country TEXT,
+    PRIMARY KEY (fingerprint, valid_from)
+);
+CREATE INDEX IF NOT EXISTS runs_valid_until ON runs (valid_until);
+COMMIT;
+"""
+
+# Columns added to months since the first version of the registry. Months
+# imported before have no signature, so they are imported once more.
+MONTHS_UPGRADE = [
+    'ALTER TABLE months ADD COLUMN size INTEGER',
+    'ALTER TABLE months ADD COLUMN mtime INTEGER',
+    'ALTER TABLE months ADD COLUMN complete INTEGER NOT NULL DEFAULT 0',
+]
+
+# How long to wait for another process updating the registry, in seconds
+LOCK_TIMEOUT = 600
+
+def month_end(month):
+    """Return the POSIX time at which the given YYYY-MM month ends."""
+    year, month = [int(part) for part in month.split('-')]
+    return calendar.timegm((year + month / 12, month % 12 + 1, 1, 0, 0, 0))
+
+def merge_runs(fingerprint, runs, records):
+    """Return the runs of a relay once the given descriptor records have
+    been added to its existing runs."""
+    # Each run is seen as the descriptors published at both of its ends
+    points = []
+    for run in runs:
+        points.append((run.valid_from, run.nickname, run.contact, run.address, run.country))
+        points.append((run.valid_until, run.nickname, run.contact, run.address, run.country))
+    for record in records:
+        points.append((record.published, record.nickname, record.contact, record.address, None))
+    points.sort(key=lambda point: point[0])
+    merged = []
+    for published, nickname, contact, address, country in points:
+        if merged and merged[-1][3:6] == [nickname, contact, address]:
+            merged[-1][2] = published
+            merged[-1][6] = merged[-1][6] or country
+        else:
+            merged.append([fingerprint, published, published, nickname, contact, address, country])
+    return [Run(*run) for run in merged]
+
+class RelayRegistry(object):
+    def __init__(self, path):
+        # Transactions are handled by hand, see import_month()
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+        self.connection.text_factory = str
+        self.connection.executescript(SCHEMA)
+        self._upgrade()
+
+    def _months_columns(self):
+        return [row[1] for row in self.connection.execute('PRAGMA table_info(months)')]
+
+    def _upgrade(self):
+        if 'complete' in self._months_columns():
+            return
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have been first
+            if 'complete' not in self._months_columns():
+                for statement in MONTHS_UPGRADE:
+                    self.connection.execute(statement)
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        self.connection.close()
+
+    def has_month(self, month, path):
+        """Tell if the server descriptors of the given month have been
+        imported from the archive at `path`. When the archive is not
+        there, an import of the whole month is enough."""
+        cursor = self.connection.execute(
+                'SELECT size, mtime, complete FROM months WHERE month = ?', (month,))
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        if os.path.exists(path):
+            return [row[0], row[1]] == archive_signature(path)
+        return bool(row[2])
+
+    def month_signature(self, month):
+        """Return what changes when the given month is imported again: its
+        number of descriptors and the signature of its archive, or None
+        if the month has not been imported."""
+        cursor = self.connection.execute(
+                'SELECT descriptors, size, mtime FROM months WHERE month = ?', (month,))
+        row = cursor.fetchone()
+        return list(row) if row is not None else None
+
+    def import_month(self, month, records, path):
+        """Add the DescriptorRecord of every server descriptor published
+        in the given month, in any order, read from the archive at `path`.
+        The archive may be downloaded while records are read, or never
+        written to disk."""
+        by_fingerprint = collections.defaultdict(list)
+        descriptors = 0
+        for record in records:
+            by_fingerprint[record.fingerprint].append(record)
+            descriptors += 1
+        if os.path.exists(path):
+            size, mtime = archive_signature(path)
+        else:
+            size, mtime = None, int(time.time())
+        # Archives are updated until the month is over
+        complete = mtime >= month_end(month)
+        # Take the write lock right away: reading runs and writing them
+        # back must not interleave with another process doing the same.
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            for fingerprint, fingerprint_records in by_fingerprint.iteritems():
+                runs = [Run(*row) for row in self.connection.execute(
+                            'SELECT * FROM runs WHERE fingerprint = ?', (fingerprint,))]
+                self.connection.execute('DELETE FROM runs WHERE fingerprint = ?', (fingerprint,))
+                self.connection.executemany('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            merge_runs(fingerprint, runs, fingerprint_records))
+            self.connection.execute(
+                    'INSERT OR REPLACE INTO months (month, descriptors, size, mtime, complete) '
+                    'VALUES (?, ?, ?, ?, ?)', (month, descriptors, size, mtime, complete))
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def runs(self, start, end):
+        """Return the runs overlapping [start, end), ordered by relay
+        fingerprint, then time."""
+        cursor = self.connection.execute(
+                'SELECT * FROM runs WHERE valid_from < ? AND valid_until >= ? '
+                'ORDER BY fingerprint, valid_from', (end, start))
+        return [Run(*row) for row in cursor]
+
+    def set_countries(self, runs):
+        """Remember the country of the given runs."""
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.executemany(
+                    'UPDATE runs SET country = ? WHERE fingerprint = ? AND valid_from = ?',
+                    [(run.country, run.fingerprint, run.valid_from) for run in runs])
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
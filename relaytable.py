@@ -0,0 +1,161 @@
+# -*- coding: utf8 -*-
+#
+# relaytable.py: parsing results of a period, cached on disk
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Store the relays of partners found in a period, with their country
+and bandwidth, as flat numpy arrays. The table is written to a cache
+file that is memory-mapped when loaded again.
+"""
+
+import json
+import mmap
+import os
+
+import numpy
+
+class StaleCacheError(Exception):
+    pass
+
+class RelayTable(object):
+    """Parsing results for a month, stored as flat arrays with one row per
+    relay and country it was in. Rows are grouped by partner.
+
+    Strings are interned: the `nickname`, `country` and `partner` columns
+    are indexes in the `nicknames`, `countries` and `partners` lists.
+    `partner_names` is indexed like `partners`."""
+
+    CACHE_MAGIC = 'exit-funding cache'
+    CACHE_VERSION = 2
+    COLUMNS = [('fingerprint', 'S40'),
+               ('nickname', '<i4'),
+               ('country', '<i4'),
+               ('partner', '<i4'),
+               ('bandwidth', '<i8'),
+               ('status_entries', '<i8')]
+
+    def __init__(self, strings, columns, buf=None):
+        self.partners = strings['partners']
+        self.partner_names = strings['partner_names']
+        self.nicknames = strings['nicknames']
+        self.countries = strings['countries']
+        for name, _ in RelayTable.COLUMNS:
+            setattr(self, name, columns[name])
+        # Keep the memory map alive as long as the columns using it
+        self._buf = buf
+
+    def __len__(self):
+        return len(self.fingerprint)
+
+    def strings(self):
+        return {'partners': self.partners,
+                'partner_names': self.partner_names,
+                'nicknames': self.nicknames,
+                'countries': self.countries}
+
+    @classmethod
+    def from_partners(cls, partners):
+        strings = {'partners': sorted(partners),
+                   'partner_names': [],
+                   'nicknames': [],
+                   'countries': []}
+        indexes = {'nicknames': {}, 'countries': {}}
+        def intern(table, value):
+            if value not in indexes[table]:
+                indexes[table][value] = len(strings[table])
+                strings[table].append(value)
+            return indexes[table][value]
+        rows = []
+        for partner_index, partner_id in enumerate(strings['partners']):
+            partner = partners[partner_id]
+            strings['partner_names'].append(partner.name)
+            # A relay that moved gets a row for each country
+            for relay in partner.relays:
+                for country, (bandwidth, status_entries_seen) in relay.country_tallies():
+                    rows.append((relay.fingerprint,
+                                 intern('nicknames', relay.nickname),
+                                 intern('countries', country),
+                                 partner_index,
+                                 bandwidth,
+                                 status_entries_seen))
+        columns = {}
+        for i, (name, dtype) in enumerate(RelayTable.COLUMNS):
+            columns[name] = numpy.array([row[i] for row in rows], dtype=dtype)
+        return cls(strings, columns)
+
+    def save(self, path, digests):
+        """Write the table to `path`. The file is made of a magic line,
+        a line of JSON describing the content, and the raw columns, each
+        aligned on 8 bytes so they can be memory-mapped."""
+        columns = [numpy.ascontiguousarray(getattr(self, name), dtype=dtype)
+                   for name, dtype in RelayTable.COLUMNS]
+        arrays = {}
+        offset = 0
+        for (name, _), column in zip(RelayTable.COLUMNS, columns):
+            arrays[name] = {'offset': offset, 'length': len(column)}
+            offset += column.nbytes + (-column.nbytes % 8)
+        header = {'version': RelayTable.CACHE_VERSION,
+                  'digests': digests,
+                  'strings': self.strings(),
+                  'arrays': arrays}
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write('%s\n' % (RelayTable.CACHE_MAGIC,))
+                f.write(json.dumps(header) + '\n')
+                f.write('\0' * (-f.tell() % 8))
+                for column in columns:
+                    f.write(column.tostring())
+                    f.write('\0' * (-column.nbytes % 8))
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass # files has not been created, also good
+            raise
+
+    @classmethod
+    def load(cls, path, digests):
+        """Memory-map the table stored in `path`. Raise StaleCacheError if
+        it has been written by another version or from other inputs than
+        the given `digests`."""
+        with open(path, 'rb') as f:
+            if f.readline() != '%s\n' % (RelayTable.CACHE_MAGIC,):
+                raise StaleCacheError('not a cache file')
+            header = json.loads(f.readline())
+            if header['version'] != RelayTable.CACHE_VERSION:
+                raise StaleCacheError('cache format version %d' % (header['version'],))
+            for name, digest in digests.iteritems():
+                if header['digests'].get(name) != digest:
+                    raise StaleCacheError('%s changed' % (name,))
+            data_start = f.tell() + (-f.tell() % 8)
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        columns = {}
+        for name, dtype in RelayTable.COLUMNS:
+            array = header['arrays'][name]
+            if array['length'] == 0:
+                columns[name] = numpy.zeros(0, dtype=dtype)
+            else:
+                columns[name] = numpy.frombuffer(buf, dtype=dtype, count=array['length'],
+                                                 offset=data_start + array['offset'])
+        return cls(header['strings'], columns, buf)
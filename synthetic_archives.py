@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# synthetic_archives.py: write fake but realistic CollecTor archives
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Write `server-descriptors-YYYY-MM.tar` and `consensuses-YYYY-MM.tar`
+archives laid out like the ones from CollecTor, plus a matching `geoip`
+file, so that exit-funding.py can be run and benchmarked offline.
+
+A share of the relays use contacts from `partners.yaml`, and relay
+countries are taken from `country-factors.yaml`.
+"""
+
+import argparse
+import base64
+import calendar
+from cStringIO import StringIO
+import datetime
+import hashlib
+import os
+import os.path
+import random
+import socket
+import struct
+import sys
+import tarfile
+
+import yaml
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+PARTNERS_FILE = os.path.join(BASE_DIR, 'partners.yaml')
+COUNTRY_FACTORS_FILE = os.path.join(BASE_DIR, 'country-factors.yaml')
+
+# The usual policy summary of exits, and a few others
+EXIT_POLICIES = ['accept 20-23,43,53,79-81,88,110,143,194,220,389,443,464-465,531,543-544,554,563,636,706,749,873,902-904,981,989-995,1194,1220,1293,1500,1533,1677,1723,1755,1863,2082-2083,2086-2087,2095-2096,2102-2104,3128,3389,3690,4321,4643,5050,5190,5222-5223,5228,5900,6660-6669,6679,6697,8000,8008,8074,8080,8087-8088,8332-8333,8443,8888,9418,9999-10000,11371,12350,19294,19638,23456,33033,64738',
+                 'accept 80,443',
+                 'reject 25,119,135-139,445,563,1214,4661-4666,6346-6429,6699,6881-6999',
+                 'accept 1-65535']
+NON_EXIT_POLICY = 'reject 1-65535'
+FLAGS = ['Fast', 'Guard', 'HSDir', 'Running', 'Stable', 'V2Dir', 'Valid']
+PLATFORMS = ['Tor 0.2.3.25 on Linux', 'Tor 0.2.4.20 on Linux', 'Tor 0.2.4.20 on FreeBSD',
+             'Tor 0.2.4.21 on Windows 7', 'Tor 0.2.5.1-alpha on Linux']
+BANDWIDTH_WEIGHTS = 'Wbd=0 Wbe=0 Wbg=4130 Wbm=10000 Wdb=10000 Web=10000 Wed=3466 Wee=10000 Weg=3466 ' \
+                    'Wem=10000 Wgb=10000 Wgd=3067 Wgg=5870 Wgm=5870 Wmb=10000 Wmd=3467 Wme=0 Wmg=4130 Wmm=10000'
+
+def b64(data):
+    return base64.b64encode(data).rstrip('=')
+
+def pem_block(rnd, name, length):
+    data = base64.b64encode(''.join(chr(rnd.randint(0, 255)) for _ in xrange(length)))
+    lines = [data[i:i + 64] for i in xrange(0, len(data), 64)]
+    return '-----BEGIN %s-----\n%s\n-----END %s-----' % (name, '\n'.join(lines), name)
+
+class SyntheticRelay(object):
+    def __init__(self, rnd, index, contact, countries, country_ranges):
+        self.nickname = 'Relay%d%s' % (index, ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in xrange(5)))[:19]
+        self.identity = hashlib.sha1('relay-%d-%d' % (index, rnd.randint(0, 2**32))).digest()
+        self.fingerprint = self.identity.encode('hex').upper()
+        self.contact = contact
+        self.country = rnd.choice(countries)
+        start, end = rnd.choice(country_ranges[self.country])
+        self.address = socket.inet_ntoa(struct.pack('!I', rnd.randint(start, end)))
+        self.is_exit = rnd.random() < 0.25
+        self.policy = rnd.choice(EXIT_POLICIES) if self.is_exit else NON_EXIT_POLICY
+        self.flags = sorted(set(rnd.sample(FLAGS, rnd.randint(3, len(FLAGS))) + ['Running', 'Valid'] +
+                                (['Exit'] if self.is_exit and self.policy != EXIT_POLICIES[2] else [])))
+        self.platform = rnd.choice(PLATFORMS)
+        # Consensus weights are roughly log-normal
+        self.bandwidth = int(rnd.lognormvariate(6, 2)) + 1
+        self.or_port = rnd.choice([443, 9001, 9090])
+        self.dir_port = rnd.choice([0, 80, 9030])
+
+    def server_descriptor(self, rnd, published):
+        lines = ['@type server-descriptor 1.0',
+                 'router %s %s %d 0 %d' % (self.nickname, self.address, self.or_port, self.dir_port),
+                 'platform %s' % (self.platform,),
+                 'protocols Link 1 2 Circuit 1',
+                 'published %s' % (published,),
+                 'fingerprint %s' % (' '.join(self.fingerprint[i:i + 4] for i in xrange(0, 40, 4)),),
+                 'uptime %d' % (rnd.randint(0, 10000000),),
+                 'bandwidth %d %d %d' % (self.bandwidth * 1000, self.bandwidth * 2000, self.bandwidth * 900),
+                 'extra-info-digest %s' % (hashlib.sha1(str(rnd.random())).hexdigest().upper(),),
+                 'onion-key',
+                 pem_block(rnd, 'RSA PUBLIC KEY', 140),
+                 'signing-key',
+                 pem_block(rnd, 'RSA PUBLIC KEY', 140),
+                 'hidden-service-dir']
+        if self.contact is not None:
+            lines.append('contact %s' % (self.contact,))
+        lines.append('ntor-onion-key %s=' % (b64(hashlib.sha256(str(rnd.random())).digest()),))
+        if self.is_exit:
+            lines.extend(['reject 0.0.0.0/8:*', 'reject 169.254.0.0/16:*', 'reject 127.0.0.0/8:*',
+                          'reject 192.168.0.0/16:*', 'reject 10.0.0.0/8:*', 'reject 172.16.0.0/12:*',
+                          'reject %s:*' % (self.address,)])
+            for ports in self.policy.split(' ', 1)[1].split(','):
+                lines.append('%s *:%s' % (self.policy.split(' ', 1)[0], ports))
+            lines.append('reject *:*')
+        else:
+            lines.append('reject *:*')
+        lines.append('router-signature')
+        lines.append(pem_block(rnd, 'SIGNATURE', 128))
+        return '\n'.join(lines) + '\n'
+
+    def status_entry(self, rnd, valid_after, unmeasured_share):
+        bandwidth = max(1, int(self.bandwidth * rnd.uniform(0.8, 1.2)))
+        unmeasured = ' Unmeasured=1' if rnd.random() < unmeasured_share else ''
+        return '\n'.join(['r %s %s %s %s %s %d %d' % (self.nickname, b64(self.identity),
+                                                     b64(hashlib.sha1(self.nickname + valid_after[:10]).digest()),
+                                                     valid_after, self.address, self.or_port, self.dir_port),
+                          's %s' % (' '.join(self.flags),),
+                          'v %s' % (self.platform.split(' on ')[0],),
+                          'w Bandwidth=%d%s' % (bandwidth, unmeasured),
+                          'p %s' % (self.policy,)])
+
+def consensus(rnd, relays, valid_after, unmeasured_share):
+    start = datetime.datetime.strptime(valid_after, '%Y-%m-%d %H:%M:%S')
+    lines = ['@type network-status-consensus-3 1.0',
+             'network-status-version 3',
+             'vote-status consensus',
+             'consensus-method 17',
+             'valid-after %s' % (valid_after,),
+             'fresh-until %s' % (start + datetime.timedelta(hours=1),),
+             'valid-until %s' % (start + datetime.timedelta(hours=3),),
+             'voting-delay 300 300',
+             'client-versions 0.2.3.25,0.2.4.20',
+             'server-versions 0.2.3.25,0.2.4.20',
+             'known-flags Authority BadExit Exit Fast Guard HSDir Named Running Stable Unnamed V2Dir Valid',
+             'params CircuitPriorityHalflifeMsec=30000 NumDirectoryGuards=3 UseOptimisticData=1 bwauthpid=1']
+    for i in xrange(8):
+        digest = hashlib.sha1('authority-%d' % (i,)).hexdigest().upper()
+        lines.extend(['dir-source authority%d %s 10.0.0.%d 10.0.0.%d 80 443' % (i, digest, i, i),
+                      'contact authority%d <authority%d@example.org>' % (i, i),
+                      'vote-digest %s' % (hashlib.sha1(valid_after + digest).hexdigest().upper(),)])
+    for relay in relays:
+        lines.append(relay.status_entry(rnd, valid_after, unmeasured_share))
+    lines.extend(['directory-footer', 'bandwidth-weights %s' % (BANDWIDTH_WEIGHTS,)])
+    for i in xrange(8):
+        lines.extend(['directory-signature %s %s' % (hashlib.sha1('authority-%d' % (i,)).hexdigest().upper(),
+                                                     hashlib.sha1('key-%d' % (i,)).hexdigest().upper()),
+                      pem_block(rnd, 'SIGNATURE', 128)])
+    return '\n'.join(lines) + '\n'
+
+def add_member(tar, name, content, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mtime = mtime
+    tar.addfile(info, StringIO(content))
+
+def country_ranges(rnd, countries):
+    """Split the IPv4 space in /16 ranges, each assigned to a country."""
+    ranges = dict((country, []) for country in countries)
+    for first in xrange(1, 224):
+        for second in xrange(0, 256, 4):
+            start = (first << 24) + (second << 16)
+            ranges[rnd.choice(countries)].append((start, start + (4 << 16) - 1))
+    return ranges
+
+def write_geoip(path, ranges):
+    flat = sorted((start, end, country) for country, country_ranges in ranges.iteritems()
+                  for start, end in country_ranges)
+    with open(path, 'w') as f:
+        f.write('# Synthetic GeoIP database written by synthetic_archives.py\n')
+        for start, end, country in flat:
+            f.write('%d,%d,%s\n' % (start, end, country.upper()))
+
+def generate(archive_dir, month, relays=2000, consensuses=None, partner_share=0.02,
+             descriptors_per_relay=2, unmeasured_share=0.05, seed=0,
+             partners_file=PARTNERS_FILE, country_factors_file=COUNTRY_FACTORS_FILE):
+    """Write synthetic archives for `month` in `archive_dir`, laid out like
+    the `archives` directory of exit-funding.py, and a `geoip` file in
+    `archive_dir/geoip`. By default, there is one consensus for every hour
+    of the month.
+
+    Return a dictionary with the paths and the number of documents
+    written."""
+    rnd = random.Random(seed)
+    year, month_number = [int(n) for n in month.split('-')]
+    days = calendar.monthrange(year, month_number)[1]
+    if consensuses is None:
+        consensuses = days * 24
+    # Patterns are left out
+    contacts = sorted(contact for info in yaml.safe_load(open(partners_file)).itervalues()
+                      for contact in info['contacts'] if isinstance(contact, basestring))
+    # YAML reads Norway (`no`) as a boolean: leave it out
+    countries = sorted(country for country in yaml.safe_load(open(country_factors_file))
+                       if isinstance(country, basestring))
+    ranges = country_ranges(rnd, countries)
+
+    synthetic_relays = []
+    for index in xrange(relays):
+        if rnd.random() < partner_share:
+            contact = rnd.choice(contacts)
+        elif rnd.random() < 0.2:
+            contact = None
+        else:
+            contact = 'Operator %d <tor-%d AT example DOT net>' % (rnd.randint(0, relays), index)
+        synthetic_relays.append(SyntheticRelay(rnd, index, contact, countries, ranges))
+
+    paths = {'descriptors': os.path.join(archive_dir, 'server-descriptors', 'server-descriptors-%s.tar' % (month,)),
+             'consensuses': os.path.join(archive_dir, 'consensuses', 'consensuses-%s.tar' % (month,)),
+             'geoip': os.path.join(archive_dir, 'geoip', 'geoip')}
+    for path in paths.itervalues():
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    write_geoip(paths['geoip'], ranges)
+
+    start = datetime.datetime(year, month_number, 1)
+    month_seconds = days * 24 * 3600
+    descriptors = []
+    for relay in synthetic_relays:
+        for _ in xrange(descriptors_per_relay):
+            descriptors.append((start + datetime.timedelta(seconds=rnd.randint(0, month_seconds - 1)), relay))
+    descriptors.sort(key=lambda (published, relay): published)
+    with tarfile.open(paths['descriptors'], 'w') as tar:
+        for published, relay in descriptors:
+            content = relay.server_descriptor(rnd, published)
+            digest = hashlib.sha1(content).hexdigest()
+            add_member(tar, 'server-descriptors-%s/%s/%s/%s' % (month, digest[0], digest[1], digest),
+                       content, calendar.timegm(published.timetuple()))
+
+    with tarfile.open(paths['consensuses'], 'w') as tar:
+        for hour in xrange(consensuses):
+            valid_after = start + datetime.timedelta(hours=hour * (days * 24) / consensuses)
+            content = consensus(rnd, synthetic_relays, str(valid_after), unmeasured_share)
+            add_member(tar, 'consensuses-%s/%02d/%s-consensus' % (month, valid_after.day, valid_after.strftime('%Y-%m-%d-%H-%M-%S')),
+                       content, calendar.timegm(valid_after.timetuple()))
+
+    return {'paths': paths,
+            'relays': relays,
+            'partner_relays': len([r for r in synthetic_relays if r.contact in contacts]),
+            'descriptors': len(descriptors),
+            'consensuses': consensuses,
+            'status_entries': consensuses * relays}
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic CollecTor archives.')
+    parser.add_argument('archive_dir', metavar='DIR', help='where to write the archives')
+    parser.add_argument('month', metavar='YYYY-MM')
+    parser.add_argument('--relays', type=int, default=2000,
+            help='number of relays (default: %(default)s)')
+    parser.add_argument('--consensuses', type=int,
+            help='number of consensuses (default: one per hour of the month)')
+    parser.add_argument('--partner-share', type=float, default=0.02,
+            help='share of relays run by partners (default: %(default)s)')
+    parser.add_argument('--descriptors-per-relay', type=int, default=2,
+            help='server descriptors published by each relay (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    result = generate(args.archive_dir, args.month, relays=args.relays, consensuses=args.consensuses,
+                      partner_share=args.partner_share, descriptors_per_relay=args.descriptors_per_relay,
+                      seed=args.seed)
+    print >>sys.stderr, "%(descriptors)d server descriptors and %(consensuses)d consensuses written " \
+                        "for %(relays)d relays, %(partner_relays)d run by partners." % result
+
+if __name__ == '__main__':
+    main()
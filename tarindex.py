@@ -0,0 +1,148 @@
+# -*- coding: utf8 -*-
+#
+# tarindex.py: random access to the members of metrics archives
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Index the members of an uncompressed tar archive: their name, where
+their data starts, their size, and for consensuses, their valid-after
+time. The index is written next to the archive, e.g.
+`consensuses-2014-01.tar.index`, and rebuilt when the archive changes.
+
+With the index, members are sliced out of a memory map of the archive,
+without going through tarfile, and members that are not wanted can be
+skipped without being read at all.
+"""
+
+from contextlib import closing
+import collections
+import json
+import mmap
+import os
+import re
+from tarfile import TarFile
+
+VALID_AFTER_RE = re.compile(r'^valid-after (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})$', re.MULTILINE)
+
+# How much of a member is read to find its valid-after time: the line
+# comes right after the few first lines of a consensus.
+HEAD_SIZE = 4096
+
+TarMember = collections.namedtuple('TarMember', ['name', 'offset', 'size', 'valid_after'])
+
+def consensus_valid_after(content):
+    """Return the valid-after time of a consensus as a
+    'YYYY-MM-DD HH:MM:SS' string, or None."""
+    match = VALID_AFTER_RE.search(content)
+    return match and match.group(1)
+
+def archive_signature(path):
+    """Return what tells if an archive changed: its size and modification
+    time."""
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+class TarIndex(object):
+    VERSION = 1
+
+    def __init__(self, path, members):
+        self.path = path
+        # List of TarMember, in archive order
+        self.members = members
+
+    @staticmethod
+    def index_path(path):
+        return path + '.index'
+
+    @classmethod
+    def build(cls, path):
+        """Index the regular, non-empty members of the archive."""
+        members = []
+        with closing(TarFile(path)) as tar:
+            with open(path, 'rb') as archive:
+                for member in tar:
+                    if not member.isfile() or member.size == 0:
+                        continue
+                    archive.seek(member.offset_data)
+                    valid_after = consensus_valid_after(archive.read(min(member.size, HEAD_SIZE)))
+                    members.append(TarMember(member.name, member.offset_data, member.size, valid_after))
+        return cls(path, members)
+
+    @classmethod
+    def load(cls, path):
+        """Return the saved index of the archive, or None if there is none
+        or if the archive changed since."""
+        try:
+            with open(TarIndex.index_path(path)) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if saved.get('version') != TarIndex.VERSION or \
+           saved.get('signature') != archive_signature(path):
+            return None
+        return cls(path, [TarMember(str(name), offset, size, valid_after and str(valid_after))
+                          for name, offset, size, valid_after in saved['members']])
+
+    @classmethod
+    def open(cls, path):
+        """Return the index of the archive, built and saved if needed."""
+        index = cls.load(path)
+        if index is None:
+            index = cls.build(path)
+            index.save()
+        return index
+
+    def save(self):
+        index_path = TarIndex.index_path(self.path)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': TarIndex.VERSION,
+                       'signature': archive_signature(self.path),
+                       'members': self.members}, f)
+        os.rename(tmp_path, index_path)
+
+    def select(self, wanted=None):
+        """Return the members for which `wanted(valid_after)` is true, and
+        those which are not consensuses, in archive order."""
+        if wanted is None:
+            return list(self.members)
+        return [member for member in self.members
+                if member.valid_after is None or wanted(member.valid_after)]
+
+def iter_tar_contents(tar):
+    """Return the content of every member of an opened tar file, in
+    order. Works for tar streams too."""
+    for member in tar:
+        if member.isfile() and member.size > 0:
+            yield tar.extractfile(member).read()
+
+def read_members(path, members):
+    """Return the content of the given TarMember of an archive, sliced out
+    of a memory map."""
+    if not members:
+        return
+    with open(path, 'rb') as archive:
+        mapping = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for member in members:
+            yield mapping[member.offset:member.offset + member.size]
+    finally:
+        mapping.close()
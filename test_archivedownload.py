@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# test_archivedownload.py: tests for archive downloads
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# Run with `python -m unittest test_archivedownload`.
+
+import BaseHTTPServer
+from cStringIO import StringIO
+import os
+import os.path
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from archivedownload import ArchiveDownloader, ArchiveFeed, DownloadError, metrics_archive_url
+
+MEMBERS = [('consensuses-2014-01/01/2014-01-01-00-00-00-consensus', 'first consensus\n'),
+           ('consensuses-2014-01/01/2014-01-01-01-00-00-consensus', 'second consensus\n' * 1000)]
+
+def make_archive(members):
+    """Return a compressed tar archive of (name, content)."""
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for name, content in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, StringIO(content))
+    tar.close()
+    xz = subprocess.Popen(['xz', '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return xz.communicate(buf.getvalue())[0]
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the files of the server, honoring `Range: bytes=N-`."""
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        ranges = self.headers.getheader('Range')
+        self.server.ranges.append(ranges)
+        offset = int(ranges[len('bytes='):-1]) if ranges else 0
+        if offset >= len(data):
+            self.send_error(416)
+            return
+        self.send_response(206 if offset else 200)
+        self.send_header('Content-Length', str(len(data) - offset))
+        self.end_headers()
+        self.wfile.write(data[offset:])
+
+    def log_message(self, *args):
+        pass
+
+class ArchiveDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), MirrorHandler)
+        self.server.files = {'/consensuses/consensuses-2014-01.tar.xz': make_archive(MEMBERS)}
+        self.server.ranges = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.downloader = ArchiveDownloader(self.directory, 'http://127.0.0.1:%d' % (self.server.server_port,))
+        self.path = os.path.join(self.directory, 'consensuses', 'consensuses-2014-01.tar')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def assertArchive(self):
+        with tarfile.open(self.path) as tar:
+            self.assertEqual([(member.name, tar.extractfile(member).read()) for member in tar], MEMBERS)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [os.path.basename(self.path)])
+
+    def test_url(self):
+        self.assertEqual(metrics_archive_url(self.path, self.directory, 'http://mirror/archive'),
+                         'http://mirror/archive/consensuses/consensuses-2014-01.tar.xz')
+
+    def test_download(self):
+        self.downloader.download_all([self.path])
+        self.assertArchive()
+        self.assertEqual(self.server.ranges, [None])
+
+    def test_resume(self):
+        compressed = self.server.files['/consensuses/consensuses-2014-01.tar.xz']
+        os.mkdir(os.path.dirname(self.path))
+        with open(self.path + '.xz.part', 'wb') as f:
+            f.write(compressed[:100])
+        self.downloader.download(self.path)
+        self.assertArchive()
+        self.assertEqual(self.server.ranges, ['bytes=100-'])
+
+    def test_corrupt(self):
+        compressed = self.server.files['/consensuses/consensuses-2014-01.tar.xz']
+        middle = len(compressed) / 2
+        self.server.files['/consensuses/consensuses-2014-01.tar.xz'] = \
+                compressed[:middle] + chr(ord(compressed[middle]) ^ 0xff) + compressed[middle + 1:]
+        self.assertRaises(DownloadError, self.downloader.download, self.path)
+        # Nothing is kept: the next run downloads it all again
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_missing(self):
+        path = os.path.join(self.directory, 'consensuses', 'consensuses-2014-02.tar')
+        self.assertRaises(Exception, self.downloader.download_all, [path])
+        self.assertFalse(os.path.exists(path))
+
+    def test_feed(self):
+        feed = ArchiveFeed(self.path, self.downloader)
+        feed.start()
+        with feed as contents:
+            self.assertEqual(list(contents), [content for _, content in MEMBERS])
+        self.assertArchive()
+
+    def test_feed_corrupt(self):
+        compressed = self.server.files['/consensuses/consensuses-2014-01.tar.xz']
+        self.server.files['/consensuses/consensuses-2014-01.tar.xz'] = compressed[:-10]
+        feed = ArchiveFeed(self.path, self.downloader)
+        feed.start()
+        with feed as contents:
+            self.assertRaises(DownloadError, list, contents)
+        self.assertFalse(os.path.exists(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# test_bandwidth_shards.py: regression tests for BandwidthShards
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# Run with `python -m unittest test_bandwidth_shards`.
+
+import shutil
+import tempfile
+import unittest
+
+from bandwidthshards import BandwidthShards
+
+A = 'A' * 40
+B = 'B' * 40
+DAY = '2014-01-01'
+
+class BandwidthShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def shards(self, fingerprints):
+        return BandwidthShards(self.directory,
+                dict((fingerprint, [(DAY, 'de')]) for fingerprint in fingerprints))
+
+    def test_resume_with_fewer_relays_does_not_drop_bandwidth(self):
+        shards = self.shards([A, B])
+        shards.add('2014-01-01 00:00:00', {A: (10, 1), B: (20, 1)})
+        shards.flush()
+        # Resumed while looking for fewer relays
+        shards = self.shards([A])
+        self.assertEqual(shards.aggregated([DAY]), set(['2014-01-01 00:00:00']))
+        shards.add('2014-01-01 01:00:00', {A: (10, 1)})
+        shards.flush()
+        # B was not looked for at 01:00: the day must be parsed again
+        shards = self.shards([A, B])
+        self.assertEqual(shards.aggregated([DAY]), set())
+        shards.add('2014-01-01 00:00:00', {A: (10, 1), B: (20, 1)})
+        shards.add('2014-01-01 01:00:00', {A: (10, 1), B: (20, 1)})
+        self.assertEqual(shards.sum([DAY]), {A: {'de': [20, 2]}, B: {'de': [40, 2]}})
+
+    def test_reuse_with_fewer_relays(self):
+        shards = self.shards([A, B])
+        shards.add('2014-01-01 00:00:00', {A: (10, 1), B: (20, 1)})
+        shards.flush()
+        shards = self.shards([A])
+        self.assertEqual(shards.sum([DAY]), {A: {'de': [10, 1]}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# test_queryserver.py: tests for the answers of --serve
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# Run with `python -m unittest test_queryserver`.
+
+import argparse
+import collections
+from cStringIO import StringIO
+import csv
+import json
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib2
+
+import numpy
+import yaml
+
+from queryserver import PeriodCache, QueryServer
+from relaytable import RelayTable
+
+Partner = collections.namedtuple('Partner', ['name', 'relays'])
+
+class Relay(collections.namedtuple('Relay', ['fingerprint', 'nickname', 'tallies'])):
+    def country_tallies(self):
+        return self.tallies
+
+A = 'A' * 40
+B = 'B' * 40
+
+class FakeInputs(object):
+    def factors_file(self, path):
+        with open(path) as f:
+            return yaml.safe_load(f)
+
+class FakeProcessor(object):
+    """Stands for an ExitFundingProcessor: supports are shared in
+    proportion to bandwidth, times the country factor in scenarios."""
+    def __init__(self, period):
+        self.period = period
+        self.monthly_amount = None
+        self.inputs = FakeInputs()
+        self.table = RelayTable.from_partners({
+                'p1': Partner('First', [Relay(A, 'alpha', [('de', (30, 1)), ('fr', (10, 1))])]),
+                'p2': Partner('Second', [Relay(B, 'beta', [('de', (60, 2))])])})
+
+    def supports(self, amount, factors):
+        weights = self.table.bandwidth * numpy.array([factors[self.table.countries[country]]
+                                                      for country in self.table.country])
+        return amount * weights / float(weights.sum())
+
+    def compute_supports(self):
+        self.relay_supports = self.supports(self.monthly_amount, {'de': 1, 'fr': 1})
+        self.partner_supports = numpy.bincount(self.table.partner, weights=self.relay_supports,
+                                               minlength=len(self.table.partners))
+
+    def sweep_supports(self, what_ifs):
+        return numpy.array([numpy.bincount(self.table.partner,
+                                           weights=self.supports(amount, self.inputs.factors_file(path)),
+                                           minlength=len(self.table.partners))
+                            for amount, _, path in what_ifs])
+
+def parse_scenario(scenario):
+    fields = scenario.split(':', 2)
+    if not fields[0].isdigit():
+        raise argparse.ArgumentTypeError("invalid scenario: %s" % (scenario,))
+    return int(fields[0]), 500, fields[2] if len(fields) > 2 else DEFAULT_FACTORS
+
+DEFAULT_FACTORS = None
+
+class PeriodCacheTest(unittest.TestCase):
+    def test_keep_recently_used(self):
+        processed = []
+        def process(period):
+            processed.append(period)
+            return FakeProcessor(period)
+        periods = PeriodCache(2, process)
+        for period in ['2014-01', '2014-02', '2014-01', '2014-03', '2014-01', '2014-02']:
+            self.assertEqual(periods.get(period).period, period)
+        self.assertEqual(processed, ['2014-01', '2014-02', '2014-03', '2014-02'])
+        self.assertEqual(periods.periods(), ['2014-01', '2014-02'])
+
+class QueryServerTest(unittest.TestCase):
+    def setUp(self):
+        global DEFAULT_FACTORS
+        self.directory = tempfile.mkdtemp()
+        DEFAULT_FACTORS = os.path.join(self.directory, 'country-factors.yaml')
+        self.archive_dir = os.path.join(self.directory, 'archives')
+        os.mkdir(self.archive_dir)
+        with open(DEFAULT_FACTORS, 'w') as f:
+            f.write('de: 1\nfr: 1\n')
+        with open(os.path.join(self.archive_dir, 'country-factors-2014-01.yaml'), 'w') as f:
+            f.write('de: 1\nfr: 3\n')
+        with open(os.path.join(self.directory, 'country-factors-other.yaml'), 'w') as f:
+            f.write('de: 1\nfr: 4\n')
+        with open(os.path.join(self.archive_dir, 'country-factors-partial.yaml'), 'w') as f:
+            f.write('de: 1\n')
+        # Tracebacks and request logs
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+        self.processed = []
+        self.server = QueryServer(('127.0.0.1', 0), PeriodCache(2, self.process), parse_scenario,
+                                  DEFAULT_FACTORS, self.archive_dir)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        sys.stderr = self.stderr
+        shutil.rmtree(self.directory)
+
+    def process(self, period):
+        if period == '2013-12':
+            raise IOError("consensuses-2013-12.tar.xz: download failed")
+        self.processed.append(period)
+        return FakeProcessor(period)
+
+    def get(self, path):
+        """Return the status and the body of the answer."""
+        url = 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+        try:
+            response = urllib2.urlopen(url)
+        except urllib2.HTTPError, e:
+            response = e
+        try:
+            return response.getcode(), response.read()
+        finally:
+            response.close()
+
+    def get_json(self, path):
+        status, body = self.get(path)
+        return status, json.loads(body)
+
+    def test_partners(self):
+        status, answer = self.get_json('/2014-01/partners?amount=100')
+        self.assertEqual(status, 200)
+        self.assertEqual(answer, {'period': '2014-01', 'amount': 100, 'partners': [
+                {'id': 'p1', 'name': 'First', 'support': 40.0, 'bandwidth': 40, 'relays': 2},
+                {'id': 'p2', 'name': 'Second', 'support': 60.0, 'bandwidth': 60, 'relays': 1}]})
+        status, answer = self.get_json('/periods')
+        self.assertEqual(answer, {'periods': ['2014-01']})
+
+    def test_relays_of_partner(self):
+        status, answer = self.get_json('/2014-01/relays?amount=100&partner=p1')
+        self.assertEqual(status, 200)
+        self.assertEqual([(row['fingerprint'], row['country'], row['support']) for row in answer['relays']],
+                         [(A, 'de', 30.0), (A, 'fr', 10.0)])
+
+    def test_period_processed_once(self):
+        for _ in xrange(3):
+            self.assertEqual(self.get('/2014-01/partners?amount=100')[0], 200)
+        self.assertEqual(self.processed, ['2014-01'])
+
+    def test_export_csv(self):
+        status, body = self.get('/2014-01/export.csv?amount=100')
+        self.assertEqual(status, 200)
+        rows = list(csv.DictReader(StringIO(body)))
+        self.assertEqual([(row['partner'], row['country'], row['support']) for row in rows],
+                         [('p1', 'de', '30.0'), ('p1', 'fr', '10.0'), ('p2', 'de', '60.0')])
+
+    def test_export_json(self):
+        status, rows = self.get_json('/2014-01/export.json?amount=100')
+        self.assertEqual(status, 200)
+        self.assertEqual([row['support'] for row in rows], [30.0, 10.0, 60.0])
+
+    def test_what_if(self):
+        factors = os.path.join(self.archive_dir, 'country-factors-2014-01.yaml')
+        status, answer = self.get_json('/2014-01/what-if?scenario=100&scenario=120:500:%s' % (factors,))
+        self.assertEqual(status, 200)
+        self.assertEqual([partner['supports'] for partner in answer['partners']],
+                         [[40.0, 60.0], [60.0, 60.0]])
+
+    def test_what_if_refused_factors(self):
+        for path in [os.path.join(self.directory, 'country-factors-other.yaml'),
+                     os.path.join(self.archive_dir, 'country-factors-missing.yaml'),
+                     os.path.join(self.archive_dir, 'country-factors-partial.yaml'),
+                     '/etc/passwd']:
+            status, answer = self.get_json('/2014-01/what-if?scenario=100:500:%s' % (path,))
+            self.assertEqual(status, 400, path)
+            self.assertIn(path, answer['error'])
+
+    def test_bad_queries(self):
+        for path in ['/2014-01/partners',
+                     '/2014-01/partners?amount=lots',
+                     '/2014-13/partners?amount=100',
+                     '/2014-01..2014-03/partners?amount=100',
+                     '/2014-01/what-if',
+                     '/2014-01/what-if?scenario=lots']:
+            status, answer = self.get_json(path)
+            self.assertEqual(status, 400, path)
+            self.assertIn('error', answer)
+        for path in ['/2014-01/nothing', '/2014-01', '/']:
+            self.assertEqual(self.get_json(path)[0], 404, path)
+
+    def test_processing_error(self):
+        status, answer = self.get_json('/2013-12/partners?amount=100')
+        self.assertEqual(status, 500)
+        self.assertIn('download failed', answer['error'])
+        # The server keeps answering
+        self.assertEqual(self.get_json('/2014-01/partners?amount=100')[0], 200)
+
+if __name__ == '__main__':
+    unittest.main()
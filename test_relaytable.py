@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# test_relaytable.py: tests for the cache of parsing results
+# Copyright © 2013 Lunar <lunar@torproject.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# Run with `python -m unittest test_relaytable`.
+
+import collections
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from relaytable import RelayTable, StaleCacheError
+
+Partner = collections.namedtuple('Partner', ['name', 'relays'])
+
+class Relay(collections.namedtuple('Relay', ['fingerprint', 'nickname', 'tallies'])):
+    def country_tallies(self):
+        return self.tallies
+
+A = 'A' * 40
+B = 'B' * 40
+DIGESTS = {'partners': 'abc', 'consensuses': [[1024, 1388534400]]}
+
+class RelayTableTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'exit-funding-2014-01.cache')
+        self.table = RelayTable.from_partners({
+                'p1': Partner('First', [Relay(A, 'alpha', [('de', (10, 1)), ('fr', (30, 2))])]),
+                'p2': Partner('Second', [Relay(B, 'beta', [('de', (20, 4))])]),
+                'p3': Partner('Third', [])})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rows(self, table):
+        return [(table.fingerprint[row],
+                 table.nicknames[table.nickname[row]],
+                 table.countries[table.country[row]],
+                 table.partners[table.partner[row]],
+                 int(table.bandwidth[row]),
+                 int(table.status_entries[row]))
+                for row in xrange(len(table))]
+
+    def test_one_row_per_relay_and_country(self):
+        self.assertEqual(self.rows(self.table),
+                         [(A, 'alpha', 'de', 'p1', 10, 1),
+                          (A, 'alpha', 'fr', 'p1', 30, 2),
+                          (B, 'beta', 'de', 'p2', 20, 4)])
+        self.assertEqual(self.table.partner_names, ['First', 'Second', 'Third'])
+
+    def test_load_saved(self):
+        self.table.save(self.path, DIGESTS)
+        loaded = RelayTable.load(self.path, DIGESTS)
+        self.assertEqual(self.rows(loaded), self.rows(self.table))
+        self.assertEqual(loaded.strings(), self.table.strings())
+
+    def test_load_empty(self):
+        table = RelayTable.from_partners({'p1': Partner('First', [])})
+        table.save(self.path, DIGESTS)
+        self.assertEqual(len(RelayTable.load(self.path, DIGESTS)), 0)
+
+    def test_stale_digests(self):
+        self.table.save(self.path, DIGESTS)
+        for name, digest in [('partners', 'def'), ('consensuses', [[1024, 1391212800]]),
+                             ('geoip', [['/usr/share/tor/geoip', 1388534400]])]:
+            digests = dict(DIGESTS)
+            digests[name] = digest
+            self.assertRaises(StaleCacheError, RelayTable.load, self.path, digests)
+
+    def test_stale_version(self):
+        self.table.save(self.path, DIGESTS)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data.replace('"version": %d' % (RelayTable.CACHE_VERSION,), '"version": 1', 1))
+        self.assertRaises(StaleCacheError, RelayTable.load, self.path, DIGESTS)
+
+    def test_not_a_cache(self):
+        with open(self.path, 'wb') as f:
+            f.write('(dp0\n')
+        self.assertRaises(StaleCacheError, RelayTable.load, self.path, DIGESTS)
+
+if __name__ == '__main__':
+    unittest.main()